@@ -0,0 +1,86 @@
+"""
+Checks that the values a function held at a breakpoint are freed once the
+breakpoint frame has been exited.
+
+Runs the extension in an InteractiveShell driven by a scripted kernel:
+
+    python -m unittest discover tests
+"""
+import collections
+import gc
+import tracemalloc
+import unittest
+
+from IPython.core.interactiveshell import InteractiveShell
+
+import xdbg.frame_tracker
+
+SIZE = 50 * 2**20
+
+class ScriptedKernel():
+    """
+    Stands in for the ipykernel loop that a breakpoint frame drives, running
+    queued cells instead of waiting for client messages
+    """
+    def __init__(self, shell):
+        self.shell = shell
+        self.cells = collections.deque()
+        self.shell_streams = []
+
+    def do_one_iteration(self):
+        if not self.cells:
+            raise RuntimeError("Ran out of cells inside a breakpoint")
+        self.shell.run_cell(self.cells.popleft(), store_history=True)
+
+    def run(self, *cells):
+        self.cells.extend(cells)
+        while self.cells:
+            self.do_one_iteration()
+
+class MemoryReleaseTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.wait_for_kernel_input = xdbg.frame_tracker.FrameTracker.wait_for_kernel_input
+        xdbg.frame_tracker.FrameTracker.wait_for_kernel_input = lambda self, timeout=1.0: None
+        cls.shell = InteractiveShell.instance()
+        cls.shell.kernel = cls.kernel = ScriptedKernel(cls.shell)
+        cls.kernel.run('%load_ext xdbg', '''
+def xdbg_test_func():
+    data = bytearray({})
+    n = len(data)
+    return n
+'''.format(SIZE), '%break xdbg_test_func 5')
+
+    @classmethod
+    def tearDownClass(cls):
+        xdbg.frame_tracker.FrameTracker.wait_for_kernel_input = cls.wait_for_kernel_input
+        del cls.shell.kernel
+
+    def retained_after(self, *cells):
+        """
+        Bytes still allocated after calling the function and running cells at
+        its breakpoint. Automatic collections are disabled, so anything freed
+        was freed by xdbg.
+        """
+        gc.collect()
+        gc.disable()
+        tracemalloc.start()
+        try:
+            before = tracemalloc.get_traced_memory()[0]
+            self.kernel.run('xdbg_test_func()', *cells)
+            return tracemalloc.get_traced_memory()[0] - before
+        finally:
+            tracemalloc.stop()
+            gc.enable()
+
+    def test_copy_released(self):
+        retained = self.retained_after('copied = data[:]', 'held = [data]', 'return n')
+        self.assertLess(retained, SIZE // 10)
+
+    def test_released_after_errors(self):
+        retained = self.retained_after('copied = data[:]', '1/0', 'for i in range(3):',
+            'return n')
+        self.assertLess(retained, SIZE // 10)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -6,6 +6,7 @@ elif sys.version_info < (3, 6):
 else:
     from . import wbyteplay as bp
 import inspect
+import textwrap
 
 # %% base class for breakpoint tables
 
@@ -19,9 +20,18 @@ class BaseBreakpointTable:
         self.counter += 1
         return num
 
-    def __call__(self, num, module_name, locals_dict):
+    def move_breakpoint(self, num, func, lineno):
         """
-        Called whenever a breakpoint is hit.
+        Called when an existing breakpoint is added again, to a new version
+        of its function
+        """
+        print("Moved breakpoint {} to {}:{}".format(num, func.__name__, lineno))
+
+    def __call__(self, num, module_name, locals_dict, closure_dict=None):
+        """
+        Called whenever a breakpoint is hit. closure_dict maps the names of
+        the function's cell and free variables to the cells themselves, and
+        is only passed for functions that have some.
         Returns a tuple (do_return, return_value)
         """
         print("Breakpoint", num, "called with locals", locals_dict)
@@ -39,32 +49,180 @@ def get_table_ref(table):
 
     global table_counter
     table_num = table_counter
+    table_counter += 1
     name = '_t{}'.format(table_num)
     globals()[name] = table
     table_refs[table] = (__name__, name)
     return table_refs[table]
 
+def share_table_ref(table, other):
+    """
+    Makes hooks added with other as their table call table instead (e.g. when
+    other only hands out the breakpoint numbers)
+    """
+    table_refs[other] = get_table_ref(table)
+
+def load_table_ops(table):
+    """
+    Returns instructions that push the table onto the stack.
+
+    The table is stored directly in the code object's constants. Importing it
+    by name (as add_breakpoint_at does) costs microseconds per hit, which is
+    fine for hooks that stop but not for ones that run on every iteration of a
+    loop. The downside is that the code object can no longer be marshalled.
+    """
+    return [(bp.LOAD_CONST, table)]
+
+# %% Compiling hooks from source
+
+def compile_in_scope(b, source, mode='exec'):
+    """
+    Compiles source code as though it appeared inside the function b (a
+    byteplay Code object), and returns a list of instructions that can be
+    spliced into b.code.
+
+    In 'exec' mode the instructions run a block of statements, and in 'eval'
+    mode they push the value of an expression.
+    """
+    cell_names = set(b.freevars)
+    cell_names.update(arg for opcode, arg in b.code
+        if bp.isopcode(opcode) and opcode in bp.hasfree)
+    local_names = set(b.args)
+    local_names.update(arg for opcode, arg in b.code
+        if bp.isopcode(opcode) and opcode in bp.haslocal)
+    local_names -= cell_names
+
+    # Local variables of b become arguments of the inner function, so that
+    # they are accessed with *_FAST instructions. Cell variables become
+    # nonlocals, which are accessed with *_DEREF instructions.
+    body = []
+    if cell_names:
+        body.append('nonlocal {}'.format(', '.join(sorted(cell_names))))
+    if mode == 'eval':
+        body.append('return ({})'.format(source))
+    else:
+        body.append(textwrap.dedent(source))
+        body.append('___xdbg_end')
+
+    container_source = 'def ___xdbg_outer():\n'
+    if cell_names:
+        container_source += '    {} = None\n'.format(' = '.join(sorted(cell_names)))
+    container_source += '    def ___xdbg_inner({}):\n'.format(', '.join(sorted(local_names)))
+    container_source += textwrap.indent('\n'.join(body), ' ' * 8) + '\n'
+    container_source += '    return ___xdbg_inner\n'
+
+    container_code = compile(container_source, '<xdbg>', 'exec')
+    outer_code = [c for c in container_code.co_consts if hasattr(c, 'co_code')][0]
+    inner_code = [c for c in outer_code.co_consts if hasattr(c, 'co_code')][0]
+    if inner_code.co_cellvars:
+        raise ValueError("Hooks can't capture local variables in nested scopes")
+
+    code = []
+    for opcode, arg in bp.Code.from_code(inner_code).code:
+        if opcode == bp.SetLineno:
+            continue
+        if opcode == bp.LOAD_GLOBAL and arg == '___xdbg_end':
+            break
+        code.append((opcode, arg))
+
+    if mode == 'eval':
+        assert code[-1][0] == bp.RETURN_VALUE
+        code.pop()
+
+    return code
+
+def substitute_globals(code, substitutions):
+    """
+    Replaces each LOAD_GLOBAL of a name in substitutions with the
+    corresponding list of instructions
+    """
+    res = []
+    for opcode, arg in code:
+        if opcode == bp.LOAD_GLOBAL and arg in substitutions:
+            res.extend(substitutions[arg])
+        else:
+            res.append((opcode, arg))
+    return res
+
 # %%
 
 # table = BaseBreakpointTable()
 
 # %%
 
-def add_breakpoint_at(table, func, code, inject_index):
-    # Hook location found, now allocate a breakpoint number
+def get_lineno(func, code, inject_index):
     lineno = func.__code__.co_firstlineno
     for prev_index in range(inject_index, -1, -1):
         opcode, arg = code[prev_index]
         if opcode == bp.SetLineno:
             lineno = arg
             break
+    return lineno
+
+def is_step_gate(code, index):
+    return (code[index:index + 1] == [(bp.NOP, None)]
+        and code[index + 2:index + 3] == [(bp.LOAD_ATTR, 'stepping')])
 
-    breakpoint_num = table.new_breakpoint(func, lineno)
+def find_inject_index(b, lineno=None):
+    inject_index = 0
+    if lineno is None:
+        # Try to inject right after the first SetLineno, skipping the step
+        # gate in front of the first line (which may have a SetLineno of
+        # its own, once the code has been through to_code)
+        start = 0
+        while is_step_gate(b.code, start) or (b.code[start:start + 1]
+                and b.code[start][0] == bp.SetLineno and is_step_gate(b.code, start + 1)):
+            start += 1
+            while start < len(b.code) and b.code[start][0] != bp.SetLineno:
+                start += 1
+        if b.code[start:start + 1] and b.code[start][0] == bp.SetLineno:
+            inject_index = start + 1
+    else:
+        for i, (opcode, arg) in enumerate(b.code):
+            if opcode == bp.SetLineno and arg == lineno:
+                inject_index = i
+                break
+        else:
+            raise ValueError("Could not find line number {}".format(lineno))
+    return inject_index
+
+def call_hook_ops(func, argc):
+    """
+    Returns instructions that call the hook below its argc arguments on the
+    stack. If func has cell or free variables, a dict from their names to the
+    cells themselves is passed as one more argument, closure_dict. Reusing
+    the cells lets the REPL write through to them, instead of to copies of
+    their values. Other functions leave it out, so tables written for three
+    arguments keep working.
+    """
+    names = func.__code__.co_cellvars + func.__code__.co_freevars
+    if not names:
+        return [(bp.CALL_FUNCTION, argc)]
+
+    ops = []
+    for name in names:
+        ops.append((bp.LOAD_CONST, name))
+        ops.append((bp.LOAD_CLOSURE, name))
+    ops.append((bp.BUILD_MAP, len(names)))
+    ops.append((bp.CALL_FUNCTION, argc + 1))
+    return ops
+
+def add_breakpoint_at(table, func, code, inject_index, num=None):
+    # Hook location found, now allocate a breakpoint number (unless an
+    # existing breakpoint is being moved here)
+    lineno = get_lineno(func, code, inject_index)
+
+    if num is None:
+        breakpoint_num = table.new_breakpoint(func, lineno)
+    else:
+        breakpoint_num = num
+        table.move_breakpoint(num, func, lineno)
     do_hook_module, do_hook_name = get_table_ref(table)
 
     continue_label = bp.Label()
 
     code[inject_index:inject_index] = [
+        (bp.NOP, None), # hooks start and end with a NOP
         (bp.LOAD_CONST, 0),
         (bp.LOAD_CONST, (do_hook_name,)),
         (bp.IMPORT_NAME, do_hook_module),
@@ -74,54 +232,684 @@ def add_breakpoint_at(table, func, code, inject_index):
         (bp.LOAD_GLOBAL, '__name__'),
         (bp.LOAD_GLOBAL, 'locals'),
         (bp.CALL_FUNCTION, 0),
-        (bp.CALL_FUNCTION, 3),
-        # Now the result of table(breakpoint_num, __name__, locals()) is on the
-        # stack. This result is a tuple (do_return, return_value).
+    ] + call_hook_ops(func, 3) + [
+        # Now the result of table(breakpoint_num, __name__, locals()[, cells])
+        # is on the stack. This result is a tuple (do_return, return_value).
         (bp.UNPACK_SEQUENCE, 2),
         (bp.POP_JUMP_IF_FALSE, continue_label),
         (bp.RETURN_VALUE, None),
         (continue_label, None),
         (bp.POP_TOP, None), # pop unused return_value
         (bp.POP_TOP, None), # pop module reference to do_hook_module
+        (bp.NOP, None),
     ]
 
     return breakpoint_num
 
-def add_breakpoint(table, func, lineno=None):
+def add_breakpoint(table, func, lineno=None, step_gates=False, num=None):
+    """
+    Adds a breakpoint to func, at the start of lineno (or of the function).
+    With step_gates, the step gates of add_step_gates are added in the same
+    pass, unless func already has them. If num is given, the existing
+    breakpoint num is moved to func instead of creating a new one.
+    """
     b = bp.Code.from_code(func.__code__)
+    # Gates go in first, so that the breakpoint runs after the gate of its
+    # line (and %next from it doesn't stop on the same line again)
+    if step_gates and not has_step_gates(table, func.__code__):
+        insert_step_gates(table, func, b.code)
+    inject_index = find_inject_index(b, lineno)
+    num = add_breakpoint_at(table, func, b.code, inject_index, num)
 
-    inject_index = 0
-    if lineno is None:
-        # Try to inject right after the first SetLineno
-        have_code = False
-        try:
-            b.code[0][0]
-            have_code = True
-        except IndexError:
-            pass
-
-        if have_code:
-            if b.code[0][0] == bp.SetLineno:
-                inject_index = 1
-    else:
-        for i, (opcode, arg) in enumerate(b.code):
-            if opcode == bp.SetLineno and arg == lineno:
-                inject_index = i
+    func.__code__ = b.to_code()
+    return num
+
+def find_returns(code):
+    """
+    Returns the indices of the RETURN_VALUE instructions in code, except the
+    ones inside hooks (e.g. for `return value` at a breakpoint)
+    """
+    indices = []
+    in_hook = False
+    for i, (opcode, arg) in enumerate(code):
+        if opcode == bp.NOP:
+            in_hook = not in_hook
+        elif opcode == bp.RETURN_VALUE and not in_hook:
+            indices.append(i)
+    return indices
+
+def add_return_breakpoint(table, func, cond=None):
+    """
+    Adds a breakpoint before every return in func, which calls
+    table.on_return(num, __name__, locals()[, cells]) with the pending
+    return value in the local variable __return__. The result is a tuple
+    (do_replace, return_value). If cond is given, the breakpoint is only hit
+    when it is true (or raises).
+    """
+    b = bp.Code.from_code(func.__code__)
+    return_indices = find_returns(b.code)
+    if not return_indices:
+        raise ValueError("{} never returns".format(func.__name__))
+
+    # The pending value goes through __return__ first, so that cond can be
+    # compiled with __return__ as a local variable
+    for index in reversed(return_indices):
+        b.code[index:index] = [
+            (bp.STORE_FAST, '__return__'),
+            (bp.LOAD_FAST, '__return__'),
+        ]
+    store_indices = [index + 2 * i for i, index in enumerate(return_indices)]
+
+    num = table.new_breakpoint(func, 'return')
+    # Hooks are inserted back to front so that earlier indices stay valid
+    for index in reversed(store_indices):
+        skip_label = bp.Label()
+        keep_label = bp.Label()
+        hook = [(bp.NOP, None), (bp.STORE_FAST, '__return__')]
+        if cond is not None:
+            hook.extend(compile_in_scope(b, """
+                try:
+                    ___xdbg_cond = bool({})
+                except Exception:
+                    ___xdbg_cond = True
+                """.format(cond)))
+            hook.extend([
+                (bp.LOAD_FAST, '___xdbg_cond'),
+                (bp.POP_JUMP_IF_FALSE, skip_label),
+            ])
+        hook.extend(load_table_ops(table))
+        hook.extend([
+            (bp.LOAD_ATTR, 'on_return'),
+            (bp.LOAD_CONST, num),
+            (bp.LOAD_GLOBAL, '__name__'),
+            (bp.LOAD_GLOBAL, 'locals'),
+            (bp.CALL_FUNCTION, 0),
+        ])
+        hook.extend(call_hook_ops(func, 3))
+        hook.extend([
+            (bp.UNPACK_SEQUENCE, 2),
+            (bp.POP_JUMP_IF_FALSE, keep_label),
+            (bp.RETURN_VALUE, None),
+            (keep_label, None),
+            (bp.POP_TOP, None), # pop unused return_value
+            (skip_label, None),
+            (bp.LOAD_FAST, '__return__'),
+            (bp.NOP, None),
+        ])
+        b.code[index:index + 2] = hook
+
+    func.__code__ = b.to_code()
+    return num
+
+def add_watchpoint(table, func, name, cond=None, step_gates=False):
+    """
+    Adds a breakpoint after every assignment to the local (or cell) variable
+    name in func, which calls table.on_watch(num, name, __name__,
+    locals()[, cells]). The result is a tuple (do_return, return_value). If cond is
+    given, the breakpoint is only hit when it is true (or raises), and is
+    evaluated inline so that assignments that don't match stay cheap.
+    step_gates is as for add_breakpoint.
+    """
+    b = bp.Code.from_code(func.__code__)
+    if step_gates and not has_step_gates(table, func.__code__):
+        insert_step_gates(table, func, b.code)
+    store_ops = {bp.STORE_FAST: bp.DELETE_FAST, bp.STORE_DEREF: bp.DELETE_DEREF}
+    # A store followed by a delete is the compiler clearing the name of an
+    # `except ... as name` block, not an assignment
+    store_indices = [i for i, (opcode, arg) in enumerate(b.code)
+        if opcode in store_ops and arg == name
+            and b.code[i + 1:i + 2] != [(store_ops[opcode], name)]]
+    if not store_indices:
+        raise ValueError("{} never assigns {}".format(func.__name__, name))
+
+    if cond is not None:
+        # Raises SyntaxError before a breakpoint is allocated
+        compile_in_scope(b, cond, mode='eval')
+
+    num = table.new_breakpoint(func, 'watch {}'.format(name))
+    # Hooks are inserted back to front so that earlier indices stay valid
+    for index in reversed(store_indices):
+        skip_label = bp.Label()
+        keep_label = bp.Label()
+        hook = [(bp.NOP, None)]
+        if cond is not None:
+            hook.extend(compile_in_scope(b, """
+                try:
+                    # Not bool(), which is a global lookup and a call
+                    ___xdbg_cond = True if ({}) else False
+                except Exception:
+                    ___xdbg_cond = True
+                """.format(cond)))
+            hook.extend([
+                (bp.LOAD_FAST, '___xdbg_cond'),
+                (bp.POP_JUMP_IF_FALSE, skip_label),
+            ])
+        hook.extend(load_table_ops(table))
+        hook.extend([
+            (bp.LOAD_ATTR, 'on_watch'),
+            (bp.LOAD_CONST, num),
+            (bp.LOAD_CONST, name),
+            (bp.LOAD_GLOBAL, '__name__'),
+            (bp.LOAD_GLOBAL, 'locals'),
+            (bp.CALL_FUNCTION, 0),
+        ])
+        hook.extend(call_hook_ops(func, 4))
+        hook.extend([
+            (bp.UNPACK_SEQUENCE, 2),
+            (bp.POP_JUMP_IF_FALSE, keep_label),
+            (bp.RETURN_VALUE, None),
+            (keep_label, None),
+            (bp.POP_TOP, None), # pop unused return_value
+            (skip_label, None),
+            (bp.NOP, None),
+        ])
+        b.code[index + 1:index + 1] = hook
+
+    func.__code__ = b.to_code()
+    return num
+
+# Instructions that can follow the code of a simple statement on the same
+# line. They belong to the compound statement around it (the end of a loop
+# body, or of a try or with block).
+BLOCK_END_OPS = {bp.POP_BLOCK, bp.POP_EXCEPT, bp.END_FINALLY}
+
+SETUP_OPS = {bp.SETUP_LOOP, bp.SETUP_EXCEPT, bp.SETUP_FINALLY, bp.SETUP_WITH,
+    getattr(bp, 'SETUP_ASYNC_WITH', bp.SETUP_WITH)}
+
+def patch_line(func, lineno, source):
+    """
+    Replaces the code of one line of func with source, compiled in the scope
+    of func. Lines with the header of a compound statement (if/for/while/
+    with/try) can't be patched, since they jump outside of their own code;
+    simple statements with jumps of their own (`a or b`, `x if c else y`)
+    can.
+    """
+    b = bp.Code.from_code(func.__code__)
+    line_indices = [i for i, (opcode, arg) in enumerate(b.code)
+        if opcode == bp.SetLineno and arg == lineno]
+    if not line_indices:
+        raise ValueError("Could not find line number {}".format(lineno))
+    if len(line_indices) > 1:
+        raise ValueError("Line {} appears more than once in the code".format(lineno))
+
+    start = line_indices[0] + 1
+    # Skip hooks at the start of the line (they start and end with a NOP)
+    while b.code[start:start + 1] == [(bp.NOP, None)]:
+        start += 1
+        while start < len(b.code) and b.code[start] != (bp.NOP, None):
+            start += 1
+        start += 1
+    limit = start
+    while limit < len(b.code) and b.code[limit][0] != bp.SetLineno:
+        limit += 1
+
+    label_indices = {opcode: i for i, (opcode, arg) in enumerate(b.code)
+        if isinstance(opcode, bp.Label)}
+    # Labels that code outside the line jumps to, where the statement
+    # around the line continues
+    outside_targets = {arg for i, (opcode, arg) in enumerate(b.code)
+        if not start <= i < limit and bp.isopcode(opcode) and opcode in bp.hasjump}
+
+    end = start
+    # (start, end) of the hooks within the line
+    hooks = []
+    while end < limit:
+        opcode, arg = b.code[end]
+        # Hooks added by this module start and end with a NOP
+        if opcode == bp.NOP:
+            hook_end = end + 1
+            while hook_end < len(b.code) and b.code[hook_end] != (bp.NOP, None):
+                hook_end += 1
+            hooks.append((end, hook_end + 1))
+            end = hook_end + 1
+            continue
+        if opcode in BLOCK_END_OPS:
+            break
+        if isinstance(opcode, bp.Label):
+            if opcode in outside_targets:
                 break
-        else:
-            raise ValueError("Could not find line number {}".format(lineno))
+        elif opcode in SETUP_OPS:
+            raise ValueError("Line {} is part of a control flow statement".format(lineno))
+        elif opcode in bp.hasjump and not end < label_indices[arg] < limit:
+            if opcode in (bp.JUMP_FORWARD, bp.JUMP_ABSOLUTE):
+                # The jump at the end of an if branch or loop body
+                break
+            raise ValueError("Line {} is part of a control flow statement".format(lineno))
+        end += 1
+        if opcode == bp.RETURN_VALUE:
+            break
+
+    # The line's own code is replaced, and hooks after it (e.g. the ones in
+    # front of a return) are kept
+    own_end = hooks[0][0] if hooks else end
+    in_hooks = {i for hook_start, hook_end in hooks for i in range(hook_start, hook_end)}
+    returns = b.code[end - 1][0] == bp.RETURN_VALUE
+    for i in range(own_end, end):
+        opcode = b.code[i][0]
+        if not (i in in_hooks or isinstance(opcode, bp.Label)
+                or (i == end - 1 and returns)):
+            raise ValueError("Line {} has hooks in the middle of its code".format(lineno))
+    if any(bp.isopcode(opcode) and opcode in bp.hasjump and not start < label_indices[arg] < own_end
+            for opcode, arg in b.code[start:own_end]):
+        raise ValueError("Line {} is part of a control flow statement".format(lineno))
+    if start == own_end:
+        raise ValueError("Line {} has no code of its own".format(lineno))
+
+    code = compile_in_scope(b, source)
+    if returns and (not code or code[-1][0] != bp.RETURN_VALUE):
+        raise ValueError("Line {} returns, so its replacement must end with a return".format(lineno))
+    if returns and own_end != end:
+        # The line's RETURN_VALUE stays after its hooks
+        code = code[:-1]
+
+    b.code[start:own_end] = code
+    func.__code__ = b.to_code()
+
+def has_table(table, code):
+    """
+    Whether code has hooks that call table, whether they load it from the
+    code's constants or import it
+    """
+    if any(const is table for const in code.co_consts):
+        return True
+    if table not in table_refs:
+        return False
+    module_name, name = table_refs[table]
+    return module_name in code.co_names and name in code.co_names
+
+def has_step_gates(table, code):
+    return 'stepping' in code.co_names and any(const is table for const in code.co_consts)
 
-    num = add_breakpoint_at(table, func, b.code, inject_index)
+def add_step_gates(table, func):
+    """
+    Adds a dormant hook before every line of func, which only calls
+    table.step(lineno, __name__, locals()[, cells]) while table.stepping is
+    set. Like a breakpoint, the result is a tuple (do_return, return_value).
+
+    The code of a frame that is already running can't be replaced, so
+    stepping has to be prepared before the function is called. Returns False
+    if func already has step gates.
+    """
+    if has_step_gates(table, func.__code__):
+        return False
+
+    b = bp.Code.from_code(func.__code__)
+    insert_step_gates(table, func, b.code)
+    func.__code__ = b.to_code()
+    return True
+
+def remove_step_gates(table, func):
+    """
+    Removes the step gates of add_step_gates, leaving other hooks in place.
+    Frames already running func keep their gates.
+    """
+    remove_hooks(func, lambda hook: (bp.LOAD_ATTR, 'stepping') in hook
+        and loads_const(hook, table))
+
+def insert_step_gates(table, func, code):
+    line_indices = [i for i, (opcode, arg) in enumerate(code)
+        if opcode == bp.SetLineno]
+    # Gates are inserted back to front so that earlier indices stay valid
+    for index in reversed(line_indices):
+        lineno = code[index][1]
+        # The gate goes before hooks already at the start of the line (e.g. a
+        # breakpoint), so that %next from them doesn't stop on the same line
+        while index > 0 and code[index - 1][0] == bp.NOP:
+            index -= 2
+            while code[index][0] != bp.NOP:
+                index -= 1
+        continue_label = bp.Label()
+        keep_label = bp.Label()
+        # Like other hooks, the gate starts and ends with a NOP (marking the
+        # end of the previous line's code)
+        gate = [(bp.NOP, None)] + load_table_ops(table) + [
+            (bp.LOAD_ATTR, 'stepping'),
+            (bp.POP_JUMP_IF_FALSE, continue_label),
+        ]
+        gate.extend(load_table_ops(table))
+        gate.extend([
+            (bp.LOAD_ATTR, 'step'),
+            (bp.LOAD_CONST, lineno),
+            (bp.LOAD_GLOBAL, '__name__'),
+            (bp.LOAD_GLOBAL, 'locals'),
+            (bp.CALL_FUNCTION, 0),
+        ])
+        gate.extend(call_hook_ops(func, 3))
+        gate.extend([
+            (bp.UNPACK_SEQUENCE, 2),
+            (bp.POP_JUMP_IF_FALSE, keep_label),
+            (bp.RETURN_VALUE, None),
+            (keep_label, None),
+            (bp.POP_TOP, None), # pop unused return_value
+            (continue_label, None),
+            (bp.NOP, None),
+        ])
+        code[index:index] = gate
+
+def add_logpoint(table, func, lineno, exprs, method='log'):
+    """
+    Adds a hook that evaluates exprs (a comma-separated string of expressions)
+    and passes a tuple of their values to table.log, without stopping.
+    Exceptions raised by the expressions are reported to table.log_error
+    instead. Another pair of table methods can be chosen with method.
+    """
+    b = bp.Code.from_code(func.__code__)
+    inject_index = find_inject_index(b, lineno)
+    exprs = exprs.strip().rstrip(',')
+    code = compile_in_scope(b, """
+        try:
+            ___xdbg_table.{method}(___xdbg_num, ({exprs},))
+        except Exception:
+            ___xdbg_table.{method}_error(___xdbg_num)
+        """.format(method=method, exprs=exprs))
+
+    num = table.new_breakpoint(func, get_lineno(func, b.code, inject_index))
+    b.code[inject_index:inject_index] = [(bp.NOP, None)] + substitute_globals(code, {
+        '___xdbg_table': load_table_ops(table),
+        '___xdbg_num': [(bp.LOAD_CONST, num)],
+    }) + [(bp.NOP, None)]
 
     func.__code__ = b.to_code()
     return num
 
+def remove_logpoint(table, func, num):
+    """
+    Removes the hook of logpoint num added by add_logpoint, leaving other
+    hooks in place
+    """
+    remove_hooks(func, lambda hook: loads_const(hook, table) and any(
+        opcode == bp.LOAD_CONST and type(arg) is int and arg == num for opcode, arg in hook))
+
+def add_line_counters(func):
+    """
+    Adds a counter to the start of every line of func, which increments an
+    entry of a list kept in the code's constants (a few instructions, with no
+    call). Returns (linenos, counts), where counts[i] is the number of times
+    line linenos[i] started. Like the line events of a trace function, a line
+    whose bytecode is split into several parts counts each of them. Unlike
+    them, the header of a for loop counts the times the loop was entered
+    (the jump back to the next iteration lands inside the line).
+    """
+    b = bp.Code.from_code(func.__code__)
+    linenos = sorted({arg for opcode, arg in b.code if opcode == bp.SetLineno})
+    counts = [0] * len(linenos)
+    slots = {lineno: i for i, lineno in enumerate(linenos)}
+    line_indices = [i for i, (opcode, arg) in enumerate(b.code)
+        if opcode == bp.SetLineno]
+    for index in reversed(line_indices):
+        # After the SetLineno, so that jumps to the line (whose Label comes
+        # before it) are counted too
+        b.code[index + 1:index + 1] = [
+            (bp.NOP, None),
+            (bp.LOAD_CONST, counts),
+            (bp.LOAD_CONST, slots[b.code[index][1]]),
+            (bp.DUP_TOP_TWO, None),
+            (bp.BINARY_SUBSCR, None),
+            (bp.LOAD_CONST, 1),
+            (bp.INPLACE_ADD, None),
+            (bp.ROT_THREE, None),
+            (bp.STORE_SUBSCR, None),
+            (bp.NOP, None),
+        ]
+
+    func.__code__ = b.to_code()
+    return linenos, counts
+
+def remove_hooks(func, is_hook):
+    """
+    Removes the hooks of func (which start and end with a NOP) whose list of
+    instructions satisfies is_hook, leaving the others in place
+    """
+    b = bp.Code.from_code(func.__code__)
+    code = []
+    i = 0
+    while i < len(b.code):
+        if b.code[i:i + 1] != [(bp.NOP, None)]:
+            code.append(b.code[i])
+            i += 1
+            continue
+        end = i + 1
+        while end < len(b.code) and b.code[end:end + 1] != [(bp.NOP, None)]:
+            end += 1
+        hook = b.code[i:end + 1]
+        if not is_hook(hook):
+            code.extend(hook)
+        i = end + 1
+
+    b.code[:] = code
+    func.__code__ = b.to_code()
+
+def loads_const(hook, value):
+    return any(opcode == bp.LOAD_CONST and arg is value for opcode, arg in hook)
+
+def remove_line_counters(func, counts):
+    """
+    Removes the counters added by add_line_counters, leaving other hooks
+    in place
+    """
+    remove_hooks(func, lambda hook: loads_const(hook, counts))
+
+PROBE_START = '___xdbg_probe_start'
+
+def add_probe(func, probe, clock, get_thread):
+    """
+    Adds a hook at the start of func that stores clock() in a local
+    variable, and one before every return that passes the call's start and
+    end times and get_thread() to probe.record (see timing.Probe). The hooks
+    only make C calls.
+    Calls that raise an exception aren't recorded, and neither are returns
+    from the REPL of a breakpoint added after the probe.
+    """
+    b = bp.Code.from_code(func.__code__)
+    if any(opcode == bp.STORE_FAST and arg == PROBE_START for opcode, arg in b.code):
+        raise ValueError("Function already has a probe")
+
+    entry_index = [opcode for opcode, arg in b.code].index(bp.SetLineno) + 1
+    # (Calls ended by `return value` at a breakpoint aren't timed)
+    for index in reversed(find_returns(b.code)):
+        # Right before the RETURN_VALUE, after any Label jumped to, with the
+        # return value at the bottom of the stack
+        b.code[index:index] = [
+            (bp.NOP, None),
+            (bp.LOAD_CONST, probe.record),
+            (bp.LOAD_FAST, PROBE_START),
+            (bp.LOAD_CONST, clock),
+            (bp.CALL_FUNCTION, 0),
+            (bp.LOAD_CONST, get_thread),
+            (bp.CALL_FUNCTION, 0),
+            (bp.BUILD_TUPLE, 3),
+            (bp.CALL_FUNCTION, 1),
+            (bp.POP_TOP, None),
+            (bp.NOP, None),
+        ]
+
+    # Right after the first SetLineno (at offset 0, so no RETURN_VALUE comes
+    # before it), and before any hook at the start of the first line
+    b.code[entry_index:entry_index] = [
+        (bp.NOP, None),
+        (bp.LOAD_CONST, clock),
+        (bp.CALL_FUNCTION, 0),
+        (bp.STORE_FAST, PROBE_START),
+        (bp.NOP, None),
+    ]
+
+    func.__code__ = b.to_code()
+
+def remove_probe(func, probe):
+    remove_hooks(func, lambda hook: loads_const(hook, probe.record)
+        or (bp.STORE_FAST, PROBE_START) in hook)
+
+def add_stopwatch(func, stopwatch, clock, clock_seconds):
+    """
+    Adds a hook at the start of line stopwatch.start_lineno of func that
+    stores clock() in a local variable, and one at the start of line
+    stopwatch.stop_lineno that passes the time since then (in seconds) to
+    stopwatch.add. Each time is measured from the last time the first line
+    was reached, and counted once.
+    """
+    if stopwatch.start_lineno <= func.__code__.co_firstlineno:
+        raise ValueError("Line {} is not in the body of the function".format(stopwatch.start_lineno))
+    if stopwatch.stop_lineno <= stopwatch.start_lineno:
+        raise ValueError("The second line must come after the first")
+    b = bp.Code.from_code(func.__code__)
+    name = stopwatch.local_name
+    entry_index = [opcode for opcode, arg in b.code].index(bp.SetLineno)
+    # The hooks go after the SetLineno of their lines (like line counters),
+    # so that jumps to the start of a line run them too
+    start_index = find_inject_index(b, stopwatch.start_lineno) + 1
+    stop_index = find_inject_index(b, stopwatch.stop_lineno) + 1
+
+    skip_label = bp.Label()
+    b.code[stop_index:stop_index] = [
+        (bp.NOP, None),
+        (bp.LOAD_FAST, name),
+        (bp.LOAD_CONST, None),
+        (bp.COMPARE_OP, 'is'),
+        (bp.POP_JUMP_IF_TRUE, skip_label),
+        (bp.LOAD_CONST, stopwatch.add),
+        (bp.LOAD_CONST, clock),
+        (bp.CALL_FUNCTION, 0),
+        (bp.LOAD_FAST, name),
+        (bp.BINARY_SUBTRACT, None),
+        (bp.LOAD_CONST, clock_seconds),
+        (bp.BINARY_MULTIPLY, None),
+        (bp.CALL_FUNCTION, 1),
+        (bp.POP_TOP, None),
+        (bp.LOAD_CONST, None),
+        (bp.STORE_FAST, name),
+        (skip_label, None),
+        (bp.NOP, None),
+    ]
+    b.code[start_index:start_index] = [
+        (bp.NOP, None),
+        (bp.LOAD_CONST, clock),
+        (bp.CALL_FUNCTION, 0),
+        (bp.STORE_FAST, name),
+        (bp.NOP, None),
+    ]
+    if start_index != entry_index + 1:
+        # The variable needs a value before the first line is reached
+        b.code[entry_index + 1:entry_index + 1] = [
+            (bp.NOP, None),
+            (bp.LOAD_CONST, None),
+            (bp.STORE_FAST, name),
+            (bp.NOP, None),
+        ]
+
+    func.__code__ = b.to_code()
+
+def remove_stopwatch(func, stopwatch):
+    name = stopwatch.local_name
+    remove_hooks(func, lambda hook: (bp.STORE_FAST, name) in hook)
+
+def add_exception_hook(table, func, num):
+    """
+    Wraps the body of func in an exception handler that calls
+    table.catch(num, __name__, locals()[, cells]) whenever an exception
+    propagates out of it. Like a breakpoint, the result is a tuple (do_return, return_value);
+    if do_return is false, the exception is re-raised with its traceback
+    intact.
+
+    Only the SETUP_EXCEPT at the start of the function runs when nothing is
+    raised. Returns False if func can't be instrumented.
+    """
+    b = bp.Code.from_code(func.__code__)
+    if b is None:
+        return False
+
+    handler_label = bp.Label()
+    reraise_label = bp.Label()
+    b.code[0:0] = [(bp.NOP, None), (bp.SETUP_EXCEPT, handler_label), (bp.NOP, None)]
+    b.code.extend([(handler_label, None), (bp.NOP, None)])
+    b.code.extend(load_table_ops(table))
+    b.code.extend([
+        (bp.LOAD_ATTR, 'catch'),
+        (bp.LOAD_CONST, num),
+        (bp.LOAD_GLOBAL, '__name__'),
+        (bp.LOAD_GLOBAL, 'locals'),
+        (bp.CALL_FUNCTION, 0),
+    ])
+    b.code.extend(call_hook_ops(func, 3))
+    b.code.extend([
+        (bp.UNPACK_SEQUENCE, 2),
+        (bp.POP_JUMP_IF_FALSE, reraise_label),
+        (bp.RETURN_VALUE, None),
+        (reraise_label, None),
+        (bp.POP_TOP, None), # pop unused return_value
+        (bp.RAISE_VARARGS, 0),
+        (bp.NOP, None),
+    ])
+
+    func.__code__ = b.to_code()
+    return True
+
+def get_arg_names(code):
+    """
+    Returns the names of the arguments of a code object, including *args and
+    **kwargs
+    """
+    count = code.co_argcount + code.co_kwonlyargcount
+    if code.co_flags & inspect.CO_VARARGS:
+        count += 1
+    if code.co_flags & inspect.CO_VARKEYWORDS:
+        count += 1
+    return code.co_varnames[:count]
+
+def add_memo_hook(table, func, num):
+    """
+    Makes func look up its result with table.memo_lookup(num, locals()) on
+    entry, and return it without running the body on a hit. On a miss, the
+    value of every return is passed through
+    table.memo_store(value, num, key), where key is whatever memo_lookup
+    returned in place of the value.
+    """
+    if func.__code__.co_flags & (inspect.CO_GENERATOR | inspect.CO_COROUTINE
+            | getattr(inspect, 'CO_ASYNC_GENERATOR', 0)):
+        raise ValueError("Generators and coroutines can't be memoized")
+
+    b = bp.Code.from_code(func.__code__)
+    store_ops = [(bp.NOP, None)] + load_table_ops(table) + [
+        (bp.LOAD_ATTR, 'memo_store'),
+        (bp.ROT_TWO, None),
+        (bp.LOAD_CONST, num),
+        (bp.LOAD_FAST, '___xdbg_memo_key'),
+        (bp.CALL_FUNCTION, 3),
+        (bp.NOP, None),
+    ]
+    for index in reversed(find_returns(b.code)):
+        b.code[index:index] = store_ops
+
+    miss_label = bp.Label()
+    inject_index = find_inject_index(b)
+    b.code[inject_index:inject_index] = [(bp.NOP, None)] + load_table_ops(table) + [
+        (bp.LOAD_ATTR, 'memo_lookup'),
+        (bp.LOAD_CONST, num),
+        (bp.LOAD_GLOBAL, 'locals'),
+        (bp.CALL_FUNCTION, 0),
+        (bp.CALL_FUNCTION, 2),
+        # Now (hit, value) is on the stack, where value is the key on a miss
+        (bp.UNPACK_SEQUENCE, 2),
+        (bp.POP_JUMP_IF_FALSE, miss_label),
+        (bp.RETURN_VALUE, None),
+        (miss_label, None),
+        (bp.STORE_FAST, '___xdbg_memo_key'),
+        (bp.NOP, None),
+    ]
+
+    func.__code__ = b.to_code()
+
+BREAKPOINT_MARKER = '___xdbg_breakpoint_here'
+
+def is_breakpoint_marker(name):
+    # Inside a class the marker's name is mangled to _Class___xdbg_breakpoint_here
+    return name == BREAKPOINT_MARKER or (name.startswith('_') and name.endswith(BREAKPOINT_MARKER))
+
 def materialize_breakpoints(table, func):
     b = bp.Code.from_code(func.__code__)
     i = 0
     while i < len(b.code):
         opcode, arg = b.code[i]
-        if opcode == bp.LOAD_GLOBAL and arg == '___xdbg_breakpoint_here':
+        if opcode == bp.LOAD_GLOBAL and is_breakpoint_marker(arg):
             assert i+1 < len(b.code), "breakpoint flag is not the last opcode"
             assert b.code[i+1][0] == bp.POP_TOP, "breakpoint flag should be followed by POP_TOP"
             del b.code[i:i+2]
@@ -0,0 +1,102 @@
+import os
+import pickle
+import inspect
+import collections
+
+class CaptureStore():
+    """
+    Directory of pickled calls to a function: the values of its arguments,
+    and optionally of the globals it references. Calls already in the
+    directory are kept, so a store can be reopened after a kernel restart.
+    """
+    def __init__(self, path, func, arg_names, global_names=()):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.func = func
+        self.arg_names = tuple(arg_names)
+        self.globals_dict = func.__globals__
+        self.global_names = tuple(global_names)
+        self.count = len([name for name in os.listdir(path) if name.endswith('.pkl')])
+        self.errors = 0
+        self.replaying = False
+
+    def call_path(self, index):
+        return os.path.join(self.path, '{:06d}.pkl'.format(index))
+
+    def append(self, locals_dict):
+        call = {
+            'args': collections.OrderedDict((name, locals_dict[name])
+                for name in self.arg_names if name in locals_dict),
+            'globals': {name: self.globals_dict[name]
+                for name in self.global_names if name in self.globals_dict},
+        }
+        data = pickle.dumps(call, pickle.HIGHEST_PROTOCOL)
+
+        path = self.call_path(self.count)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        self.count += 1
+
+    def load(self, index):
+        if index < 0:
+            index += self.count
+        if not 0 <= index < self.count:
+            raise IndexError("No captured call {}".format(index))
+        with open(self.call_path(index), 'rb') as f:
+            return pickle.load(f)
+
+def find_global_names(code, globals_dict):
+    """
+    Returns the names of the globals referenced by code (and the functions
+    nested in it) that hold data, as opposed to modules, functions or classes
+    """
+    names = set()
+    codes = [code]
+    while codes:
+        code = codes.pop()
+        names.update(code.co_names)
+        codes.extend(const for const in code.co_consts if inspect.iscode(const))
+
+    res = []
+    for name in sorted(names):
+        if name not in globals_dict:
+            continue
+        value = globals_dict[name]
+        if (inspect.ismodule(value) or inspect.isroutine(value)
+                or inspect.isclass(value)):
+            continue
+        res.append(name)
+    return res
+
+def replay_call(func, call):
+    """
+    Calls func with the arguments of a captured call, and the captured values
+    of globals swapped in for the duration of the call
+    """
+    code = func.__code__
+    args = call['args']
+    names = code.co_varnames
+
+    positional = [args[name] for name in names[:code.co_argcount]]
+    index = code.co_argcount + code.co_kwonlyargcount
+    keywords = {name: args[name] for name in names[code.co_argcount:index]}
+    if code.co_flags & inspect.CO_VARARGS:
+        positional.extend(args[names[index]])
+        index += 1
+    if code.co_flags & inspect.CO_VARKEYWORDS:
+        keywords.update(args[names[index]])
+
+    globals_dict = func.__globals__
+    missing = object()
+    old_globals = {name: globals_dict.get(name, missing) for name in call['globals']}
+    globals_dict.update(call['globals'])
+    try:
+        return func(*positional, **keywords)
+    finally:
+        for name, value in old_globals.items():
+            if value is missing:
+                globals_dict.pop(name, None)
+            else:
+                globals_dict[name] = value
@@ -0,0 +1,113 @@
+import os
+import ast
+
+# A definitions-only module keeps the statements of a module's source that
+# build its namespace cheaply: imports, def and class statements, and
+# assignments of literals (or of other names). Everything else at the top
+# level is dropped, such as loading data, connecting to servers, or the
+# `if __name__ == '__main__'` block.
+
+def is_constant(node):
+    """
+    Returns whether an expression is a literal, or a reference to a name
+    (possibly through attributes)
+    """
+    if isinstance(node, (ast.Num, ast.Str, ast.Bytes, ast.NameConstant, ast.Ellipsis)):
+        return True
+    elif isinstance(node, getattr(ast, 'Constant', ())):
+        return True
+    elif isinstance(node, (ast.Tuple, ast.List, ast.Set)):
+        return all(is_constant(elt) for elt in node.elts)
+    elif isinstance(node, ast.Dict):
+        return all(key is None or is_constant(key) for key in node.keys) and all(
+            is_constant(value) for value in node.values)
+    elif isinstance(node, ast.UnaryOp):
+        return is_constant(node.operand)
+    elif isinstance(node, ast.BinOp):
+        return is_constant(node.left) and is_constant(node.right)
+    elif isinstance(node, ast.Name):
+        return True
+    elif isinstance(node, ast.Attribute):
+        return isinstance(node.value, (ast.Name, ast.Attribute)) and is_constant(node.value)
+    return False
+
+def is_name_target(node):
+    if isinstance(node, ast.Name):
+        return True
+    elif isinstance(node, (ast.Tuple, ast.List)):
+        return all(is_name_target(elt) for elt in node.elts)
+    return False
+
+def filter_definitions(body):
+    """
+    Returns the statements of body that are kept by a definitions-only
+    module. try statements are kept (with their blocks filtered) when their
+    body has something left, for the `try: import x except ImportError:`
+    pattern.
+    """
+    res = []
+    for i, stmt in enumerate(body):
+        if isinstance(stmt, (ast.Import, ast.ImportFrom, ast.FunctionDef,
+                ast.AsyncFunctionDef, ast.ClassDef)):
+            res.append(stmt)
+        elif isinstance(stmt, ast.Expr) and i == 0 and isinstance(stmt.value, ast.Str):
+            # Docstring
+            res.append(stmt)
+        elif isinstance(stmt, ast.Assign):
+            if all(is_name_target(target) for target in stmt.targets) and is_constant(stmt.value):
+                res.append(stmt)
+        elif isinstance(stmt, getattr(ast, 'AnnAssign', ())):
+            if (isinstance(stmt.target, ast.Name)
+                    and (stmt.value is None or is_constant(stmt.value))):
+                res.append(stmt)
+        elif isinstance(stmt, ast.Try):
+            stmt.body = filter_definitions(stmt.body)
+            if not stmt.body:
+                continue
+            for handler in stmt.handlers:
+                handler.body = filter_definitions(handler.body) or [ast.copy_location(ast.Pass(), handler)]
+            stmt.orelse = filter_definitions(stmt.orelse)
+            stmt.finalbody = filter_definitions(stmt.finalbody)
+            res.append(stmt)
+    return res
+
+# path -> (mtime, size, [(lineno, code), ...])
+definition_cache = {}
+
+def compile_definitions(path, source=None):
+    """
+    Returns the kept statements of the module at path, each compiled on its
+    own as a (lineno, code) pair, so that one of them failing doesn't stop
+    the rest. Results are cached until the file changes.
+    """
+    stat = os.stat(path)
+    cached = definition_cache.get(path)
+    if cached is not None and cached[:2] == (stat.st_mtime_ns, stat.st_size):
+        return cached[2]
+
+    if source is None:
+        with open(path, 'rb') as f:
+            source = f.read()
+    tree = ast.parse(source, path)
+
+    codes = []
+    for stmt in filter_definitions(tree.body):
+        module = ast.Module(body=[stmt])
+        codes.append((stmt.lineno, compile(module, path, 'exec', dont_inherit=True)))
+
+    definition_cache[path] = (stat.st_mtime_ns, stat.st_size, codes)
+    return codes
+
+def exec_definitions(codes, namespace):
+    """
+    Runs the compiled statements of a definitions-only module in namespace.
+    Returns a list of (lineno, exception) for the statements that failed,
+    e.g. because they depend on a name that was never assigned.
+    """
+    failed = []
+    for lineno, code in codes:
+        try:
+            exec(code, namespace)
+        except Exception as e:
+            failed.append((lineno, e))
+    return failed
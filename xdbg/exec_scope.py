@@ -10,6 +10,12 @@ class ExecScope():
             self.locals_cells.update(closure_dict)
         self.shell = shell
 
+    def release(self):
+        """
+        Drop the cells once the frame this scope belongs to has been exited
+        """
+        self.locals_cells = {}
+
     @staticmethod
     def create_cell(y):
         def foo(x):
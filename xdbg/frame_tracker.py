@@ -1,10 +1,78 @@
-import inspect
 import sys, os
 from IPython.core.interactiveshell import InteractiveShell
 from .exec_scope import ExecScope
+from .remote import RemoteRelay, RemoteExecScope, serve_remote_frame
 import ast
 import types
 import importlib
+import threading
+import collections
+import gc
+import signal
+
+# Return value of a frame that was exited with a bare `return`
+NO_VALUE = object()
+# Return value of a frame that was exited to let the function keep running
+# (e.g. by %next)
+CONTINUE = object()
+
+# Sent to the kernel thread to have it enter parked frames in the middle of a
+# cell (see %threads --auto). A signal that arrives just before the thread
+# blocks is only handled once it wakes up, so it is sent again until the frame
+# is entered.
+AUTO_ENTER_SIGNAL = getattr(signal, 'SIGUSR2', None)
+AUTO_ENTER_RETRY_SECONDS = 0.1
+
+class Frame():
+    """
+    A breakpoint frame on the FrameTracker stack
+    """
+    __slots__ = ('frame_name', 'module', 'locals', 'entry_names', 'old_module',
+        'old_locals', 'exec_scope', 'old_run_ast_nodes', 'old_traceback',
+        'old_collections', 'python_frame', 'lineno', 'has_returned', 'return_value',
+        'temporary')
+
+    def __init__(self, frame_name, module=None, locals_dict=None, temporary=False):
+        self.frame_name = frame_name
+        self.module = module
+        self.locals = locals_dict
+        self.entry_names = None
+        self.old_module = None
+        self.old_locals = None
+        self.exec_scope = None
+        self.old_run_ast_nodes = None
+        self.old_traceback = None
+        self.old_collections = None
+        # The frame of the function that hit the breakpoint, when known
+        self.python_frame = None
+        self.lineno = None
+        self.has_returned = False
+        self.return_value = NO_VALUE
+        self.temporary = temporary
+
+    def release(self):
+        """
+        Drop everything the frame holds on to, once it has been exited.
+
+        The locals dict belongs to the function that hit the breakpoint, so
+        only the names the shell added to it (_oh, _, _i1, ...) are removed.
+        """
+        if self.locals is not None and self.entry_names is not None:
+            for name in list(self.locals.keys()):
+                if name not in self.entry_names:
+                    del self.locals[name]
+        if self.exec_scope is not None:
+            self.exec_scope.release()
+
+        self.module = None
+        self.locals = None
+        self.entry_names = None
+        self.old_module = None
+        self.old_locals = None
+        self.exec_scope = None
+        self.old_run_ast_nodes = None
+        self.old_traceback = None
+        self.python_frame = None
 
 class ReturnRewriter(ast.NodeTransformer):
     def __init__(self, debugger):
@@ -33,23 +101,48 @@ class FrameTracker():
     def __init__(self, shell):
         self.shell = shell
         self.using_kernel = hasattr(self.shell, 'kernel')
+        if self.using_kernel:
+            # Writing to this pipe wakes up a kernel loop that is parked inside
+            # a breakpoint (see wait_for_kernel_input)
+            self.wakeup_r, self.wakeup_w = os.pipe()
+            os.set_blocking(self.wakeup_r, False)
+            os.set_blocking(self.wakeup_w, False)
         self.main_module = self.shell.user_module
+        # Only the thread that runs the shell can drive the REPL. Breakpoints
+        # hit on any other thread are parked until %switch enters them, or
+        # with auto_enter, until the shell's thread runs a top-level cell (see
+        # set_auto_enter). cell_running tells whether it is running a cell in
+        # the innermost frame.
+        self.thread_ident = threading.get_ident()
+        self.cell_running = False
+        self.auto_enter = False
+        self.entering_parked = False
+        self.old_signal_handler = None
+        # Reentrant, since the signal handler can run while the shell's
+        # thread holds it
+        self.parked_lock = threading.RLock()
+        self.parked_counter = 0
+        self.parked_threads = collections.OrderedDict()
+        # Forked child processes relay their breakpoints back to this process.
+        # The relay is only started by the first fork after relay_forks().
+        self.pid = os.getpid()
+        self.relay = None
+        self.relaying_forks = False
         if hasattr(self.shell, '_xdbg_frame_tracker'):
             raise ValueError("Can't create a second FrameTracker, use shell._xdbg_frame_tracker instead")
         self.shell._xdbg_frame_tracker = self
 
         self.frames = []
-        self.frames.append({
-            'temporary': True,
-            'module': self.main_module,
-            'frame_name': '__main__'
-        })
+        self.frames.append(Frame('__main__', module=self.main_module, temporary=True))
 
         # Initialize the return handler
         self.shell.ast_transformers.append(ReturnRewriter(self))
 
+        self.shell.events.register('pre_execute', self.on_pre_execute)
+        self.shell.events.register('post_execute', self.on_post_execute)
+
     def get_return_call_ast(self):
-        if not self.frames or self.frames[-1]['temporary']:
+        if not self.frames or self.frames[-1].temporary:
             return None
         module = ast.parse('get_ipython()._xdbg_frame_tracker.exit_frame(1)')
         expr = module.body[0]
@@ -57,26 +150,83 @@ class FrameTracker():
         args.pop()
         return expr, args
 
+    def current_locals(self):
+        """
+        Returns the variables of the current frame, including the values
+        assigned since it was entered
+        """
+        frame = self.frames[-1]
+        if frame.temporary:
+            return dict(self.shell.user_ns)
+
+        res = dict(frame.locals)
+        for name, cell in getattr(frame.exec_scope, 'locals_cells', {}).items():
+            try:
+                res[name] = cell.cell_contents
+            except ValueError:
+                # Deleted, or never assigned
+                res.pop(name, None)
+        return res
+
     def eval(self, source):
         return eval(source, self.shell.user_module.__dict__, self.shell.user_ns)
 
     def enter_module(self, module):
-        if not self.frames or not self.frames[-1]['temporary']:
+        if not self.frames or not self.frames[-1].temporary:
             return
 
-        if self.frames[-1]['module'] == module:
+        if self.frames[-1].module == module:
             return
 
         frame = self.frames[-1]
-        frame['module'] = module
-        frame['frame_name'] = module.__name__
+        frame.module = module
+        frame.frame_name = module.__name__
 
         if '_oh' not in module.__dict__:
             module._oh = {}
         self.shell.user_module = module
         self.shell.user_ns = module.__dict__
 
-    def enter_frame(self, module_name, locals_dict, frame_name=None, closure_dict=None, stack_skip=1):
+    def relay_forks(self):
+        """
+        Start the relay before the next fork, so that child processes forked
+        from here on can relay their breakpoints back
+        """
+        if self.relaying_forks:
+            return
+        self.relaying_forks = True
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(before=self.start_relay)
+        else:
+            fork = os.fork
+            def fork_with_relay():
+                self.start_relay()
+                return fork()
+            os.fork = fork_with_relay
+
+    def start_relay(self):
+        if self.relay is not None or os.getpid() != self.pid:
+            return
+        try:
+            self.relay = RemoteRelay(self)
+        except OSError as e:
+            print("[xdbg] Can't relay breakpoints from child processes:", e, file=sys.stderr)
+
+    def enter_frame(self, module_name, locals_dict, frame_name=None, closure_dict=None, stack_skip=1, exec_scope=None, lineno=None):
+        if os.getpid() != self.pid:
+            if frame_name is None:
+                frame_name = self.get_frame_name(module_name, stack_skip + 1)
+            return serve_remote_frame(self, module_name, locals_dict,
+                frame_name=frame_name,
+                closure_dict=closure_dict)
+
+        if threading.get_ident() != self.thread_ident:
+            return self.park_thread(module_name, locals_dict,
+                frame_name=frame_name,
+                closure_dict=closure_dict,
+                stack_skip=stack_skip + 1)
+
+        entry_names = set(locals_dict.keys())
         if '_oh' not in locals_dict:
             locals_dict['_oh'] = {}
 
@@ -88,69 +238,327 @@ class FrameTracker():
         if 'get_ipython' not in module.__dict__:
             module.get_ipython = get_ipython
 
-        frame = {
-            'frame_name': frame_name if frame_name is not None else "<unknown>",
-            'old_module': self.shell.user_module,
-            'old_locals': self.shell.user_ns,
-            'module': module,
-            'locals': locals_dict,
-            'has_returned': False,
-            'return_value': None,
-            'exec_scope': ExecScope(module.__dict__,
-                locals_dict,
-                shell=self.shell,
-                closure_dict=closure_dict),
-            'old_run_ast_nodes': self.shell.run_ast_nodes,
-            'temporary': False,
-        }
+        frame = Frame(frame_name if frame_name is not None else "<unknown>",
+            module=module,
+            locals_dict=locals_dict)
+        frame.entry_names = entry_names
+        frame.lineno = lineno
+        frame.old_module = self.shell.user_module
+        frame.old_locals = self.shell.user_ns
+        frame.old_run_ast_nodes = self.shell.run_ast_nodes
+        frame.old_traceback = getattr(sys, 'last_traceback', None)
+        frame.old_collections = self.older_collections()
+        frame.exec_scope = exec_scope if exec_scope is not None else ExecScope(module.__dict__,
+            locals_dict,
+            shell=self.shell,
+            closure_dict=closure_dict)
 
+        freevars = ()
         if frame_name is None:
             try:
-                stack = inspect.stack()
-                frame_name = '<{}>.{}'.format(module_name, stack[stack_skip].function)
-                frame['frame_name'] = frame_name
+                # sys._getframe rather than inspect.stack, whose frame records
+                # would form a reference cycle with this function's locals
+                caller = sys._getframe(stack_skip)
+                frame.frame_name = '<{}>.{}'.format(module_name, caller.f_code.co_name)
+                frame.python_frame = caller
+                freevars = caller.f_code.co_freevars
+                del caller
             except:
                 pass
 
         self.frames.append(frame)
 
-        self.shell.user_module = frame['module']
-        self.shell.user_ns = frame['locals']
+        self.shell.user_module = frame.module
+        self.shell.user_ns = frame.locals
 
-        print('[xdbg] Entered:', frame['frame_name'])
-        if closure_dict is None and stack[stack_skip].frame.f_code.co_freevars:
-            # There's no reliable way to get closure info at runtime... but,
-            # the %break obj syntax that creates proxy objects can get closure
-            # info
+        print('[xdbg] Entered:', frame.frame_name)
+        if closure_dict is None and freevars:
+            # Breakpoint hooks pass the function's cells, but frames entered
+            # some other way may only have the values of its nonlocals
             print('[xdgb] Warning: nonlocals copied by value')
         self.shell.execution_count += 1 # Needed to keep ID's unique
-        self.shell.run_ast_nodes = frame['exec_scope'].shell_substitute_run_ast_nodes
+        self.shell.run_ast_nodes = frame.exec_scope.shell_substitute_run_ast_nodes
+
+        cell_running = self.cell_running
+        self.cell_running = False
 
         # Need to continue the main kernel loop without returning from here
         try:
             if self.using_kernel:
-                while not frame['has_returned']:
+                while not frame.has_returned:
                     self.shell.kernel.do_one_iteration()
+                    if not frame.has_returned:
+                        self.wait_for_kernel_input()
             else:
                 # The kernel-less IPython shell doesn't expose do_one_iteration,
                 # so an alternative codepath is needed
                 self.shell.interact()
-                if frame['has_returned']:
+                if frame.has_returned:
                     self.shell.keep_running = True
 
-            return frame['return_value']
+            return frame.return_value
         except:
             raise
         finally:
-            print('[xdbg] Exited:', frame['frame_name'])
-            self.shell.run_ast_nodes = frame['old_run_ast_nodes']
-            self.shell.user_module = frame['old_module']
-            self.shell.user_ns = frame['old_locals']
+            print('[xdbg] Exited:', frame.frame_name)
+            # The cell that hit the breakpoint carries on
+            self.cell_running = cell_running
+            self.shell.run_ast_nodes = frame.old_run_ast_nodes
+            self.shell.user_module = frame.old_module
+            self.shell.user_ns = frame.old_locals
+            if getattr(sys, 'last_traceback', None) is not frame.old_traceback:
+                self.forget_traceback()
+            frame.release()
+            # Compiling cells leaves behind cyclic garbage (codeop keeps the
+            # SyntaxErrors of incomplete input, with their tracebacks). The
+            # dead frames in it link back to the function that hit the
+            # breakpoint, and would keep its locals alive until the next
+            # collection. Unless the garbage was promoted to the oldest
+            # generation while the frame was open, collecting the young
+            # generations is enough, and much cheaper than a full collection.
+            if self.older_collections() == frame.old_collections:
+                gc.collect(1)
+            else:
+                gc.collect()
+            self.request_auto_enter()
+
+    @staticmethod
+    def older_collections():
+        """
+        Number of times gc has collected generations 1 and 2, each of which
+        promotes the survivors to generation 2
+        """
+        stats = gc.get_stats()
+        return stats[1]['collections'] + stats[2]['collections']
+
+
+    def forget_traceback(self):
+        """
+        Drop the last traceback shown by the shell. A traceback from an error
+        raised at a breakpoint keeps the frame's cells alive.
+        """
+        sys.last_type = sys.last_value = sys.last_traceback = None
+        interactive_tb = getattr(self.shell, 'InteractiveTB', None)
+        if getattr(interactive_tb, 'tb', None) is not None:
+            interactive_tb.tb = None
+        # The last SyntaxError is kept too, and its traceback links back to
+        # the frame through f_back
+        syntax_tb = getattr(self.shell, 'SyntaxTB', None)
+        if getattr(syntax_tb, 'last_syntax_error', None) is not None:
+            syntax_tb.last_syntax_error = None
+
+    def on_pre_execute(self):
+        if threading.get_ident() == self.thread_ident:
+            self.cell_running = True
+            self.request_auto_enter()
+
+    def on_post_execute(self):
+        if threading.get_ident() == self.thread_ident:
+            self.cell_running = False
+
+    def set_auto_enter(self, enabled):
+        """
+        While enabled, the shell's thread enters parked frames whenever it is
+        running a top-level cell, pausing the cell until they return. That
+        includes cells that wait for the parked threads, which are
+        interrupted with AUTO_ENTER_SIGNAL. Returns False if signals can't be
+        used here.
+        """
+        if enabled == self.auto_enter:
+            return True
+        if threading.get_ident() != threading.main_thread().ident or AUTO_ENTER_SIGNAL is None:
+            # Signal handlers can only run on the main thread
+            return False
+        if enabled:
+            self.old_signal_handler = signal.signal(AUTO_ENTER_SIGNAL, self.on_auto_enter_signal)
+        else:
+            signal.signal(AUTO_ENTER_SIGNAL, self.old_signal_handler)
+            self.old_signal_handler = None
+        self.auto_enter = enabled
+        return True
+
+    def request_auto_enter(self):
+        if self.auto_enter and self.cell_running:
+            signal.pthread_kill(self.thread_ident, AUTO_ENTER_SIGNAL)
+
+    def on_auto_enter_signal(self, signum, frame):
+        # The cell may have ended since the signal was sent, or the user may
+        # be working in a breakpoint frame, whose cells are left alone
+        if (self.auto_enter and self.cell_running and not self.entering_parked
+                and self.frames[-1].temporary):
+            self.enter_all_parked()
+
+    def enter_all_parked(self):
+        self.entering_parked = True
+        try:
+            while True:
+                with self.parked_lock:
+                    if not self.parked_threads:
+                        return
+                    num, parked = self.parked_threads.popitem(last=False)
+                print('[xdbg] Entering parked frame {} ({})'.format(num, parked['thread_name']))
+                self.enter_parked(parked)
+        finally:
+            self.entering_parked = False
+
+    def park_thread(self, module_name, locals_dict, frame_name=None, closure_dict=None, stack_skip=1):
+        """
+        Called instead of enter_frame on threads other than the one driving
+        the REPL.
+
+        Blocks the calling thread until the frame has been entered with
+        %switch (or by auto_enter) and returned from. Other threads keep
+        running in the meantime.
+        """
+        thread = threading.current_thread()
+        if frame_name is None:
+            frame_name = self.get_frame_name(module_name, stack_skip + 1)
+
+        parked = {
+            'thread_name': thread.name,
+            'frame_name': frame_name,
+            'module_name': module_name,
+            'locals': locals_dict,
+            'closure_dict': closure_dict,
+            'return_value': NO_VALUE,
+            'done': threading.Event(),
+        }
+        with self.parked_lock:
+            num = self.parked_counter
+            self.parked_counter += 1
+            self.parked_threads[num] = parked
+
+        print('[xdbg] Parked: {} in thread {} (%switch {})'.format(
+            frame_name, thread.name, num))
+        self.wait_parked(num, parked)
+        return parked['return_value']
+
+    def wait_parked(self, num, parked):
+        """
+        Block until parked frame num has been entered and returned from
+        """
+        if not self.auto_enter and self.cell_running:
+            # %switch can't run until the cell ends
+            print('[xdbg] A cell is running. Interrupt it if it waits for {},'
+                ' then %switch {} (or use %threads --auto)'.format(
+                parked['thread_name'], num))
+        while True:
+            with self.parked_lock:
+                is_parked = num in self.parked_threads
+            if is_parked:
+                self.request_auto_enter()
+            if parked['done'].wait(AUTO_ENTER_RETRY_SECONDS):
+                return
+
+    def park_remote(self, pid, frame_name, module_name, connection):
+        """
+        Called by the relay, on a thread of its own, when a child process hits
+        a breakpoint. Like park_thread, blocks until the frame is returned from.
+        """
+        parked = {
+            'thread_name': 'pid {}'.format(pid),
+            'frame_name': frame_name,
+            'module_name': module_name,
+            'pid': pid,
+            'connection': connection,
+            'done': threading.Event(),
+        }
+        with self.parked_lock:
+            num = self.parked_counter
+            self.parked_counter += 1
+            self.parked_threads[num] = parked
+
+        print('[xdbg] Parked: {} in process {} (%switch {})'.format(
+            frame_name, pid, num))
+        self.wake_up()
+        self.wait_parked(num, parked)
+
+    def get_frame_name(self, module_name, stack_skip=1):
+        try:
+            return '<{}>.{}'.format(module_name, sys._getframe(stack_skip).f_code.co_name)
+        except:
+            return "<unknown>"
 
+    def list_parked_threads(self):
+        with self.parked_lock:
+            items = list(self.parked_threads.items())
+        return [(num, parked['thread_name'], parked['frame_name'])
+            for num, parked in items]
 
-    def exit_frame(self, val=None):
+    def switch_thread(self, num):
+        """
+        Enter a frame parked by park_thread. The thread that owns the frame is
+        released once the frame is returned from. Returns False if there is no
+        parked frame num.
+        """
+        with self.parked_lock:
+            parked = self.parked_threads.pop(num, None)
+        if parked is None:
+            return False
+        self.enter_parked(parked)
+        return True
+
+    def enter_parked(self, parked):
+        try:
+            if 'connection' in parked:
+                exec_scope = RemoteExecScope(self, parked['connection'], parked['pid'])
+                self.enter_frame(parked['module_name'], {},
+                    frame_name='{} [pid {}]'.format(parked['frame_name'], parked['pid']),
+                    closure_dict={},
+                    exec_scope=exec_scope)
+            else:
+                parked['return_value'] = self.enter_frame(parked['module_name'],
+                    parked['locals'],
+                    frame_name='{} [thread {}]'.format(
+                        parked['frame_name'], parked['thread_name']),
+                    closure_dict=parked['closure_dict'])
+        finally:
+            parked['done'].set()
+
+    def kernel_streams(self):
+        kernel = self.shell.kernel
+        streams = list(getattr(kernel, 'shell_streams', None) or [])
+        if not streams and getattr(kernel, 'shell_stream', None) is not None:
+            streams.append(kernel.shell_stream)
+        if getattr(kernel, 'control_stream', None) is not None:
+            streams.append(kernel.control_stream)
+        return streams
+
+    def wait_for_kernel_input(self, timeout=1.0):
+        """
+        Block until a kernel message arrives or wake_up() is called.
+
+        do_one_iteration() only polls the kernel's sockets without waiting, so
+        calling it in a loop would spin a CPU core for as long as a breakpoint
+        is open.
+        """
+        import zmq
+        poller = zmq.Poller()
+        for stream in self.kernel_streams():
+            poller.register(stream.socket, zmq.POLLIN)
+        poller.register(self.wakeup_r, zmq.POLLIN)
+        poller.poll(None if timeout is None else int(timeout * 1000))
+
+        try:
+            while os.read(self.wakeup_r, 4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def wake_up(self):
+        if not self.using_kernel:
+            return
+        try:
+            os.write(self.wakeup_w, b'\0')
+        except BlockingIOError:
+            # The pipe is full, so a wakeup is already pending
+            pass
+
+    def exit_frame(self, val=NO_VALUE):
         frame = self.frames.pop()
-        frame['return_value'] = val
-        frame['has_returned'] = True
+        frame.return_value = val
+        frame.has_returned = True
         if not self.using_kernel:
             self.shell.keep_running = False
+        else:
+            self.wake_up()
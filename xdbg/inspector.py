@@ -0,0 +1,129 @@
+import sys
+import time
+import types
+import itertools
+import collections
+
+# Sizes are estimated without stalling on huge objects: buffers report their
+# own size through `nbytes`, and containers are only walked to a limited depth
+# and number of items (the rest is extrapolated). All of it stops once a
+# deadline passes.
+
+MAX_DEPTH = 3
+MAX_ITEMS = 1000
+
+# Walking into these would count shared interpreter state, not the value
+OPAQUE_TYPES = (type, types.ModuleType, types.FunctionType, types.BuiltinFunctionType,
+    types.MethodType, types.CodeType, types.FrameType)
+
+class SizeEstimator():
+    """
+    Estimates the memory held by a value, counting each object it references
+    once
+    """
+    def __init__(self, deadline):
+        self.deadline = deadline
+        self.seen = set()
+        self.exact = True
+
+    def children(self, value):
+        if isinstance(value, dict):
+            return itertools.chain.from_iterable(value.items()), 2 * len(value)
+        elif isinstance(value, (list, tuple, set, frozenset, collections.deque)):
+            return iter(value), len(value)
+        elif isinstance(value, OPAQUE_TYPES):
+            return None, 0
+        attrs = getattr(value, '__dict__', None)
+        if isinstance(attrs, dict):
+            return iter((attrs,)), 1
+        return None, 0
+
+    def size_of(self, value, depth=0):
+        if id(value) in self.seen:
+            return 0
+        self.seen.add(id(value))
+
+        nbytes = getattr(value, 'nbytes', None)
+        if isinstance(nbytes, int):
+            return nbytes
+
+        size = sys.getsizeof(value, 0)
+        if depth >= MAX_DEPTH:
+            return size
+
+        items, count = self.children(value)
+        if items is None:
+            return size
+
+        walked = 0
+        child_size = 0
+        try:
+            for item in itertools.islice(items, MAX_ITEMS):
+                if time.perf_counter() > self.deadline:
+                    break
+                child_size += self.size_of(item, depth + 1)
+                walked += 1
+        except RuntimeError:
+            # Changed size during iteration, e.g. by another thread
+            pass
+
+        if walked < count:
+            self.exact = False
+            if walked:
+                child_size = child_size * count // walked
+        return size + child_size
+
+def format_size(size):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1024:
+            break
+        size /= 1024
+    else:
+        unit = 'TB'
+    if unit == 'B':
+        return '{} B'.format(int(size))
+    return '{:.1f} {}'.format(size, unit)
+
+def describe_shape(value):
+    shape = getattr(value, 'shape', None)
+    if isinstance(shape, tuple):
+        return 'x'.join(str(dim) for dim in shape) if shape else '()'
+    if isinstance(value, OPAQUE_TYPES):
+        return ''
+    try:
+        return 'len {}'.format(len(value))
+    except Exception:
+        return ''
+
+def describe_locals(namespace, budget=1.0):
+    """
+    Returns rows of (name, type, shape, dtype, size) for the values in
+    namespace, largest first. Sizes are None for values that were not reached
+    within the time budget (in seconds), and start with '~' when extrapolated.
+    """
+    deadline = time.perf_counter() + budget
+    rows = []
+    for name, value in namespace.items():
+        type_name = type(value).__name__
+        if time.perf_counter() > deadline:
+            rows.append((name, type_name, '', '', None, -1))
+            continue
+
+        shape = describe_shape(value)
+        dtype = getattr(value, 'dtype', None)
+        dtype = '' if dtype is None or isinstance(value, type) else str(dtype)
+
+        estimator = SizeEstimator(deadline)
+        try:
+            size = estimator.size_of(value)
+        except Exception:
+            rows.append((name, type_name, shape, dtype, None, -1))
+            continue
+
+        size_text = format_size(size)
+        if not estimator.exact:
+            size_text = '~' + size_text
+        rows.append((name, type_name, shape, dtype, size_text, size))
+
+    rows.sort(key=lambda row: -row[5])
+    return [row[:5] for row in rows]
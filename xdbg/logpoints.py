@@ -0,0 +1,40 @@
+class LogError():
+    """
+    Recorded in place of the values when a logpoint expression raises
+    """
+    def __init__(self, exception):
+        self.exception = exception
+
+    def __repr__(self):
+        return '<error: {!r}>'.format(self.exception)
+
+class LogBuffer():
+    """
+    Fixed-size ring buffer of logpoint hits. Appending never allocates beyond
+    the entry itself, and the oldest entries are overwritten once full.
+    """
+    def __init__(self, capacity=10000):
+        self.capacity = capacity
+        self.entries = [None] * capacity
+        self.count = 0
+
+    def append(self, num, values):
+        self.entries[self.count % self.capacity] = (num, values)
+        self.count += 1
+
+    def clear(self):
+        self.entries = [None] * self.capacity
+        self.count = 0
+
+    def read(self, last=None):
+        """
+        Returns a list of (hit_index, num, values), oldest first
+        """
+        available = min(self.count, self.capacity)
+        if last is not None:
+            available = min(available, last)
+        res = []
+        for hit_index in range(self.count - available, self.count):
+            num, values = self.entries[hit_index % self.capacity]
+            res.append((hit_index, num, values))
+        return res
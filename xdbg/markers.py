@@ -0,0 +1,275 @@
+import os
+import sys
+import dis
+import marshal
+import hashlib
+import inspect
+import importlib.abc
+import importlib.machinery
+import importlib.util
+from .breakpoint_hooks import (BaseBreakpointTable, get_table_ref, share_table_ref,
+                               is_breakpoint_marker, materialize_breakpoints)
+from .session import PendingFunction, BreakpointFinder, replace_consts, find_spec_after
+
+# Functions can ask for a breakpoint in their source with a line that is just
+# `___xdbg_breakpoint_here`. While MarkerFinder is installed, these markers
+# are turned into breakpoint hooks as modules are imported.
+#
+# The instrumented code of a module is cached with marshal, so that later
+# imports (in this process or another) skip disassembling it. The numbers of
+# its breakpoints differ between processes, so the hooks in the cache hold
+# placeholder constants instead, and the cache records where they are. When
+# the code is loaded, each placeholder is swapped for a new breakpoint's
+# number, which only rebuilds the code objects on the way to it.
+
+CACHE_VERSION = 1
+# Placeholders are ints above this, each a distinct object (the constants of
+# a code object are shared by identity, so an int the function uses itself
+# never ends up in a placeholder's slot)
+PLACEHOLDER_BASE = 1 << 62
+
+def default_cache_dir():
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    return os.path.join(cache_home, 'xdbg', 'markers')
+
+def names_marker(code):
+    return any(is_breakpoint_marker(name) for name in code.co_names)
+
+def has_markers(code):
+    if names_marker(code):
+        return True
+    return any(inspect.iscode(const) and has_markers(const) for const in code.co_consts)
+
+def marks_function(code):
+    """
+    Returns whether code is the body of a function that uses the marker
+    (at module and class level it is looked up with LOAD_NAME, and left alone)
+    """
+    return (names_marker(code) and code.co_flags & inspect.CO_NEWLOCALS
+        and any(instr.opname == 'LOAD_GLOBAL' and is_breakpoint_marker(instr.argval)
+            for instr in dis.get_instructions(code)))
+
+class PlaceholderTable(BaseBreakpointTable):
+    """
+    Stands in for the breakpoint table while markers are materialized,
+    handing out placeholder numbers
+    """
+    def __init__(self):
+        # id(placeholder) -> (placeholder, lineno)
+        self.placeholders = {}
+
+    def new_breakpoint(self, func, lineno):
+        placeholder = PLACEHOLDER_BASE + len(self.placeholders)
+        self.placeholders[id(placeholder)] = (placeholder, lineno)
+        return placeholder
+
+def materialize_code(numbers, code):
+    if marks_function(code):
+        func = PendingFunction(code)
+        materialize_breakpoints(numbers, func)
+        code = func.__code__
+
+    consts = tuple(materialize_code(numbers, const)
+        if inspect.iscode(const) and has_markers(const) else const
+        for const in code.co_consts)
+    if any(new is not old for new, old in zip(consts, code.co_consts)):
+        code = replace_consts(code, consts)
+    return code
+
+def find_placeholders(code, placeholders, path=()):
+    """
+    Returns (path, index, lineno) for each placeholder in code, where path
+    is the indices in co_consts that lead to the code object holding it
+    """
+    hooks = []
+    for index, const in enumerate(code.co_consts):
+        found = placeholders.get(id(const))
+        if found is not None and found[0] is const:
+            hooks.append((path, index, found[1]))
+        elif inspect.iscode(const):
+            hooks.extend(find_placeholders(const, placeholders, path + (index,)))
+    return hooks
+
+def materialize_module(table, code):
+    """
+    Returns (code, hooks): the code of a module with the markers in its
+    functions turned into breakpoints of table, numbered by placeholders,
+    and where the placeholders are
+    """
+    numbers = PlaceholderTable()
+    share_table_ref(table, numbers)
+    code = materialize_code(numbers, code)
+    return code, find_placeholders(code, numbers.placeholders)
+
+def code_at(code, path):
+    for index in path:
+        code = code.co_consts[index]
+    return code
+
+def replace_path_consts(code, replacements, path=()):
+    """
+    Returns code with the constants in replacements (mapping a path to
+    {index: value}) swapped in
+    """
+    consts = list(code.co_consts)
+    for index, value in replacements.get(path, {}).items():
+        consts[index] = value
+    for index in {p[len(path)] for p in replacements if len(p) > len(path) and p[:len(path)] == path}:
+        consts[index] = replace_path_consts(consts[index], replacements, path + (index,))
+    return replace_consts(code, tuple(consts))
+
+def number_breakpoints(table, code, hooks):
+    """
+    Returns code with its placeholders swapped for new breakpoints of table,
+    and the numbers of the new breakpoints
+    """
+    replacements = {}
+    nums = []
+    for path, index, lineno in hooks:
+        path = tuple(path)
+        num = table.new_breakpoint(PendingFunction(code_at(code, path)), lineno)
+        replacements.setdefault(path, {})[index] = num
+        nums.append(num)
+    if replacements:
+        code = replace_path_consts(code, replacements)
+    return code, nums
+
+class MarkerCache():
+    """
+    Instrumented module code on disk, keyed by a hash of the module's source
+    and path, and by the interpreter's bytecode version
+    """
+    def __init__(self, path):
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, filename, source, table_ref):
+        digest = hashlib.sha1()
+        for part in (str(CACHE_VERSION), filename, '.'.join(table_ref)):
+            digest.update(part.encode('utf-8') + b'\0')
+        digest.update(source)
+        return '{}.{}'.format(digest.hexdigest(), sys.implementation.cache_tag)
+
+    def load(self, key):
+        try:
+            with open(os.path.join(self.path, key), 'rb') as f:
+                data = f.read()
+        except OSError:
+            return None
+        magic = importlib.util.MAGIC_NUMBER
+        if not data.startswith(magic):
+            return None
+        try:
+            version, hooks, code = marshal.loads(data[len(magic):])
+        except (EOFError, ValueError, TypeError):
+            return None
+        if version != CACHE_VERSION or not inspect.iscode(code):
+            return None
+        return code, hooks
+
+    def store(self, key, code, hooks):
+        path = os.path.join(self.path, key)
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            with open(tmp_path, 'wb') as f:
+                f.write(importlib.util.MAGIC_NUMBER)
+                f.write(marshal.dumps((CACHE_VERSION, hooks, code)))
+            os.replace(tmp_path, path)
+        except OSError:
+            # The cache only saves time, so a read-only disk isn't an error
+            pass
+
+class MarkerLoader(importlib.abc.Loader):
+    """
+    Wraps the loader of a module, and materializes the markers in its code
+    """
+    def __init__(self, loader, finder):
+        self.loader = loader
+        self.finder = finder
+
+    def __getattr__(self, name):
+        return getattr(self.loader, name)
+
+    def create_module(self, spec):
+        return self.loader.create_module(spec)
+
+    def get_code(self, fullname):
+        code = self.loader.get_code(fullname)
+        if code is None or not has_markers(code):
+            return code
+        return self.materialize(fullname, code)
+
+    def materialize(self, fullname, code):
+        source = self.loader.get_source(fullname)
+        if source is None:
+            return code
+        table = self.finder.table
+        cache = self.finder.cache
+        key = cache.key(code.co_filename, source.encode('utf-8'), get_table_ref(table))
+        cached = cache.load(key)
+        if cached is None:
+            cache.misses += 1
+            code, hooks = materialize_module(table, code)
+            cache.store(key, code, hooks)
+        else:
+            cache.hits += 1
+            code, hooks = cached
+
+        code, nums = number_breakpoints(table, code, hooks)
+        self.finder.on_loaded(fullname, nums)
+        return code
+
+    def exec_module(self, module):
+        code = self.loader.get_code(module.__name__)
+        if code is None:
+            return self.loader.exec_module(module)
+        if has_markers(code):
+            code = self.materialize(module.__name__, code)
+        else:
+            # Nothing to do when the module is reloaded, so hand it back to
+            # its own loader (which other tools may look for)
+            module.__loader__ = self.loader
+            if getattr(module, '__spec__', None) is not None:
+                module.__spec__.loader = self.loader
+        exec(code, module.__dict__)
+
+class MarkerFinder(importlib.abc.MetaPathFinder):
+    """
+    Sits on sys.meta_path while markers are materialized at import time
+    """
+    def __init__(self, table, on_loaded, cache_dir=None):
+        self.table = table
+        self.on_loaded = on_loaded
+        self.cache = MarkerCache(cache_dir or default_cache_dir())
+
+    def install(self):
+        if self in sys.meta_path:
+            return
+        # Saved breakpoints are added on top of the materialized code, so
+        # this finder goes after the one that adds them
+        index = 0
+        while index < len(sys.meta_path) and isinstance(sys.meta_path[index], BreakpointFinder):
+            index += 1
+        sys.meta_path.insert(index, self)
+
+    def uninstall(self):
+        if self in sys.meta_path:
+            sys.meta_path.remove(self)
+
+    @property
+    def installed(self):
+        return self in sys.meta_path
+
+    def find_spec(self, fullname, path, target=None):
+        spec = find_spec_after(self, fullname, path, target)
+        if spec is None:
+            return None
+        loader = spec.loader
+        # Extension modules and zip imports have no source code to
+        # instrument (and their loaders don't all support exec_module)
+        if not isinstance(loader, importlib.machinery.SourceFileLoader):
+            return spec
+        spec.loader = MarkerLoader(loader, self)
+        return spec
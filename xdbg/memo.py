@@ -0,0 +1,103 @@
+import os
+import pickle
+import hashlib
+import collections
+
+# Returned instead of a key when a call's arguments can't be cached
+NO_KEY = object()
+
+class MemoCache():
+    """
+    LRU cache of a function's results, keyed on the values of its arguments.
+
+    Arguments are compared by equality when they are hashable, and by their
+    pickled form otherwise. If a path is given, results are also stored there
+    as pickles, and survive the cache (or the kernel) being reset.
+    """
+    def __init__(self, arg_names, maxsize=128, path=None):
+        self.arg_names = tuple(arg_names)
+        self.maxsize = maxsize
+        self.path = path
+        if path is not None:
+            os.makedirs(path, exist_ok=True)
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def make_key(self, locals_dict):
+        try:
+            key = tuple(locals_dict[name] for name in self.arg_names)
+        except KeyError:
+            return NO_KEY
+
+        try:
+            hash(key)
+            return key
+        except TypeError:
+            pass
+        try:
+            return pickle.dumps(key, pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            return NO_KEY
+
+    def file_path(self, key):
+        if not isinstance(key, bytes):
+            key = pickle.dumps(key, pickle.HIGHEST_PROTOCOL)
+        return os.path.join(self.path, hashlib.sha256(key).hexdigest() + '.pkl')
+
+    def lookup(self, key):
+        """
+        Returns a tuple (hit, value)
+        """
+        try:
+            value = self.entries[key]
+        except KeyError:
+            pass
+        else:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return True, value
+
+        if self.path is not None:
+            try:
+                with open(self.file_path(key), 'rb') as f:
+                    value = pickle.load(f)
+            except Exception:
+                pass
+            else:
+                self.remember(key, value)
+                self.hits += 1
+                return True, value
+
+        self.misses += 1
+        return False, None
+
+    def remember(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def store(self, key, value):
+        self.remember(key, value)
+        if self.path is None:
+            return
+
+        # Values that can't be pickled are only kept in memory
+        try:
+            data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+            path = self.file_path(key)
+        except Exception:
+            return
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def clear(self):
+        """
+        Forget the results held in memory. Results stored on disk are kept.
+        """
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0
@@ -0,0 +1,80 @@
+import os
+import sys
+import importlib.util
+
+def normalize_path(path):
+    return os.path.normcase(os.path.realpath(os.path.abspath(path)))
+
+def module_paths(module):
+    """
+    Returns the source paths of a module, from its __file__ and its spec's
+    origin (which differ e.g. for modules loaded from .pyc files)
+    """
+    # Read from __dict__, since lazy and shim modules can import things (or
+    # fail) when their attributes are accessed
+    try:
+        namespace = vars(module)
+    except TypeError:
+        return set()
+    paths = set()
+    spec = namespace.get('__spec__')
+    for path in (namespace.get('__file__'), getattr(spec, 'origin', None)):
+        if not isinstance(path, str) or not os.path.isabs(path):
+            # Skips 'built-in', 'frozen' and other non-file origins
+            continue
+        if path.endswith(('.pyc', '.pyo')):
+            # Bytecode in __pycache__ belongs to the source file next to it
+            try:
+                path = importlib.util.source_from_cache(path)
+            except ValueError:
+                pass
+        paths.add(normalize_path(path))
+    return paths
+
+class ModuleIndex():
+    """
+    Maps the source paths of loaded modules to their names in sys.modules.
+
+    Modules are indexed by the first lookup that misses after they are
+    loaded. A lookup that hits doesn't walk sys.modules at all, and one that
+    misses only resolves the paths of modules it hasn't seen before.
+    """
+    def __init__(self):
+        self.paths = {}
+        self.modules = {}
+
+    def update(self):
+        for name, module in list(sys.modules.items()):
+            if module is None or self.modules.get(name) is module:
+                continue
+            self.modules[name] = module
+            for path in module_paths(module):
+                # Keep the first name a file was imported under, e.g. when a
+                # script is both __main__ and an importable module
+                if self.paths.get(path) in (None, name) or not self.is_current(self.paths[path]):
+                    self.paths[path] = name
+
+        if len(self.modules) > len(sys.modules):
+            for name in [name for name in self.modules if name not in sys.modules]:
+                del self.modules[name]
+
+    def is_current(self, name):
+        module = self.modules.get(name)
+        return module is not None and sys.modules.get(name) is module
+
+    def lookup(self, path):
+        """
+        Returns the loaded module whose source is at path, or None. Package
+        directories resolve to their __init__.py.
+        """
+        path = normalize_path(path)
+        if os.path.isdir(path):
+            path = os.path.join(path, '__init__.py')
+
+        name = self.paths.get(path)
+        if name is None or not self.is_current(name):
+            self.update()
+            name = self.paths.get(path)
+        if name is None or not self.is_current(name):
+            return None
+        return sys.modules[name]
@@ -0,0 +1,150 @@
+import os, sys, io
+import threading
+import traceback
+from contextlib import redirect_stdout, redirect_stderr
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Listener, Client
+from .exec_scope import ExecScope
+
+# Breakpoints are installed in the kernel, and child processes created with
+# fork() inherit them. A child that hits a breakpoint has no kernel of its own,
+# so it connects back to the kernel's RemoteRelay and serves the cells the user
+# runs until the frame is returned from.
+
+class RemoteValue():
+    """
+    Stands in for the result of a cell that was evaluated in another process
+    """
+    def __init__(self, text):
+        self.text = text
+
+    def __repr__(self):
+        return self.text
+
+class RemoteExecScope():
+    """
+    Kernel-side replacement for ExecScope that runs cells inside the frame of
+    a child process
+    """
+    def __init__(self, frame_tracker, connection, pid):
+        self.frame_tracker = frame_tracker
+        self.connection = connection
+        self.pid = pid
+
+    def release(self):
+        self.connection = None
+
+    def shell_substitute_run_ast_nodes(
+                self,
+                nodelist, cellname, interactivity='last_expr',
+                compiler=compile, # ignored
+                result=None,
+            ):
+        """
+        Replaces get_ipython().run_ast_nodes
+        """
+        if not nodelist:
+            return
+
+        try:
+            self.connection.send(nodelist)
+            value_repr, output, error_text, has_returned = self.connection.recv()
+        except (EOFError, OSError):
+            print('[xdbg] Lost connection to process', self.pid, file=sys.stderr)
+            self.frame_tracker.exit_frame()
+            return True
+
+        if output:
+            sys.stdout.write(output)
+        if error_text is not None:
+            sys.stderr.write(error_text)
+        elif value_repr is not None and interactivity == 'last_expr':
+            sys.displayhook(RemoteValue(value_repr))
+
+        if has_returned:
+            self.connection.close()
+            self.frame_tracker.exit_frame()
+        return error_text is not None
+
+class RemoteRelay():
+    """
+    Accepts connections from child processes that hit a breakpoint, and
+    queues them alongside parked threads
+    """
+    def __init__(self, frame_tracker):
+        self.frame_tracker = frame_tracker
+        self.authkey = os.urandom(16)
+        self.listener = Listener(authkey=self.authkey)
+        self.address = self.listener.address
+
+        self.thread = threading.Thread(target=self.accept_loop, name='xdbg-relay')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def accept_loop(self):
+        while True:
+            try:
+                connection = self.listener.accept()
+                pid, frame_name, module_name = connection.recv()
+            except (OSError, EOFError, AuthenticationError):
+                continue
+            # Parking blocks until the frame is returned from, and shouldn't
+            # hold up other processes
+            thread = threading.Thread(target=self.frame_tracker.park_remote,
+                args=(pid, frame_name, module_name, connection),
+                name='xdbg-relay-{}'.format(pid))
+            thread.daemon = True
+            thread.start()
+
+def serve_remote_frame(frame_tracker, module_name, locals_dict, frame_name, closure_dict=None):
+    """
+    Runs in the child process: connects to the kernel and executes the cells
+    it sends until the frame is returned from. If the kernel can't be reached,
+    or the connection drops first, the function carries on.
+    """
+    from .frame_tracker import Frame, CONTINUE
+    try:
+        connection = Client(frame_tracker.relay.address, authkey=frame_tracker.relay.authkey)
+    except (AttributeError, OSError):
+        print('[xdbg] Process {} hit a breakpoint but cannot reach the kernel'.format(os.getpid()),
+            file=sys.stderr)
+        return CONTINUE
+
+    try:
+        module = sys.modules[module_name]
+    except KeyError:
+        module = frame_tracker.main_module
+
+    # The kernel rewrites `return` into a call to exit_frame, which will pop
+    # this frame from the (forked) frame tracker
+    frame = Frame(frame_name, module=module, locals_dict=locals_dict)
+    frame_tracker.frames.append(frame)
+    exec_scope = ExecScope(module.__dict__, locals_dict, closure_dict=closure_dict)
+
+    try:
+        connection.send((os.getpid(), frame_name, module_name))
+        while not frame.has_returned:
+            nodelist = connection.recv()
+
+            output = io.StringIO()
+            value_repr = None
+            error_text = None
+            with redirect_stdout(output), redirect_stderr(output):
+                try:
+                    value = exec_scope.exec_ast_nodes(nodelist)
+                    if value is not None:
+                        value_repr = repr(value)
+                except:
+                    error_text = traceback.format_exc()
+            connection.send((value_repr, output.getvalue(), error_text, frame.has_returned))
+    except (EOFError, OSError):
+        print('[xdbg] Process {} lost its connection to the kernel'.format(os.getpid()),
+            file=sys.stderr)
+        return CONTINUE
+    finally:
+        if frame in frame_tracker.frames:
+            frame_tracker.frames.remove(frame)
+        connection.close()
+        exec_scope.release()
+
+    return frame.return_value
@@ -0,0 +1,192 @@
+import os
+import sys
+import dis
+import json
+import types
+import inspect
+import importlib.abc
+from .breakpoint_hooks import add_breakpoint
+from .sites import nearest_line
+
+# A saved session is a JSON file with one record per breakpoint, giving its
+# site (see sites.py) and its settings:
+#   {"version": 1, "breakpoints": [{"module": ..., "qualname": ...,
+#     "accessor": ..., "firstlineno": ..., "offset": ..., "text": ...,
+#     "enabled": ..., "temporary": ..., "ignore_count": ...}, ...]}
+# Breakpoints in modules that aren't imported yet are added by
+# BreakpointFinder while the module is imported, to the code objects of its
+# functions before the functions are created.
+
+SESSION_VERSION = 1
+
+def save_session(path, records):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump({'version': SESSION_VERSION, 'breakpoints': records}, f, indent=1)
+    os.replace(tmp_path, path)
+
+def load_session(path):
+    with open(path) as f:
+        session = json.load(f)
+    if session.get('version') != SESSION_VERSION:
+        raise ValueError("Unsupported session version: {}".format(session.get('version')))
+    return session['breakpoints']
+
+def replace_consts(code, consts):
+    return types.CodeType(code.co_argcount, code.co_kwonlyargcount, code.co_nlocals,
+        code.co_stacksize, code.co_flags, code.co_code, consts, code.co_names,
+        code.co_varnames, code.co_filename, code.co_name, code.co_firstlineno,
+        code.co_lnotab, code.co_freevars, code.co_cellvars)
+
+def replace_nested_code(code, parts, firstlineno, transform):
+    """
+    Returns code with the code object reached through the names in parts
+    (e.g. ['Class', 'method']) replaced by transform(inner_code), or None if
+    there is no such code object, or more than one
+    """
+    candidates = [i for i, const in enumerate(code.co_consts)
+        if inspect.iscode(const) and const.co_name == parts[0]]
+    if len(parts) == 1 and len(candidates) > 1:
+        # e.g. the getter and setter of a property
+        candidates = [i for i in candidates if code.co_consts[i].co_firstlineno == firstlineno]
+    if len(candidates) != 1:
+        return None
+
+    index = candidates[0]
+    inner = code.co_consts[index]
+    if len(parts) == 1:
+        inner = transform(inner)
+    else:
+        inner = replace_nested_code(inner, parts[1:], firstlineno, transform)
+    if inner is None:
+        return None
+
+    consts = list(code.co_consts)
+    consts[index] = inner
+    return replace_consts(code, tuple(consts))
+
+class PendingFunction():
+    """
+    Stands in for a function whose code object is instrumented before the
+    function itself is created
+    """
+    def __init__(self, code):
+        self.__code__ = code
+        self.__name__ = code.co_name
+
+def site_lineno(code, source_lines, record):
+    """
+    Returns the line number of a saved site in code, or None for the start
+    of the function. Raises ValueError if the line is gone.
+    """
+    if record['offset'] is None:
+        return None
+    start = code.co_firstlineno
+    end = max(lineno for offset, lineno in dis.findlinestarts(code))
+    index = nearest_line(source_lines[start - 1:end], record['offset'], record['text'])
+    if index is None:
+        raise ValueError("Line not found: {}".format(record['text']))
+    return start + index
+
+def find_spec_after(finder, fullname, path, target=None):
+    """
+    Returns the spec that the finders after finder on sys.meta_path find for
+    a module, or None
+    """
+    meta_path = list(sys.meta_path)
+    start = meta_path.index(finder) + 1 if finder in meta_path else 0
+    for other in meta_path[start:]:
+        if not hasattr(other, 'find_spec'):
+            continue
+        spec = other.find_spec(fullname, path, target)
+        if spec is not None:
+            return spec
+    return None
+
+class BreakpointLoader(importlib.abc.Loader):
+    """
+    Wraps the loader of a module with saved breakpoints, and adds them to its
+    code before it runs
+    """
+    def __init__(self, loader, finder):
+        self.loader = loader
+        self.finder = finder
+
+    def __getattr__(self, name):
+        # get_source and friends are used by inspect and linecache
+        return getattr(self.loader, name)
+
+    def create_module(self, spec):
+        return self.loader.create_module(spec)
+
+    def exec_module(self, module):
+        name = module.__name__
+        code = self.loader.get_code(name)
+        records = self.finder.pending.pop(name, [])
+        if not self.finder.pending:
+            self.finder.uninstall()
+        try:
+            source_lines = self.loader.get_source(name).splitlines()
+        except Exception:
+            source_lines = None
+
+        added = []
+        remaining = []
+        for record in records:
+            if source_lines is None:
+                remaining.append(record)
+                continue
+            def transform(inner):
+                func = PendingFunction(inner)
+                try:
+                    lineno = site_lineno(inner, source_lines, record)
+                    num = add_breakpoint(self.finder.table, func, lineno)
+                except ValueError:
+                    return None
+                added.append((num, lineno, record))
+                return func.__code__
+            new_code = replace_nested_code(code, record['qualname'].split('.'),
+                record['firstlineno'], transform)
+            if new_code is None:
+                remaining.append(record)
+            else:
+                code = new_code
+
+        exec(code, module.__dict__)
+        self.finder.on_loaded(module, added, remaining)
+
+class BreakpointFinder(importlib.abc.MetaPathFinder):
+    """
+    Sits at the front of sys.meta_path while saved breakpoints are waiting
+    for their modules to be imported
+    """
+    def __init__(self, table, on_loaded):
+        self.table = table
+        self.on_loaded = on_loaded
+        # module name -> list of records
+        self.pending = {}
+
+    def install(self):
+        if self not in sys.meta_path:
+            sys.meta_path.insert(0, self)
+
+    def uninstall(self):
+        if self in sys.meta_path:
+            sys.meta_path.remove(self)
+
+    def add(self, record):
+        self.pending.setdefault(record['module'], []).append(record)
+        self.install()
+
+    def find_spec(self, fullname, path, target=None):
+        if fullname not in self.pending:
+            return None
+        spec = find_spec_after(self, fullname, path, target)
+        if spec is None:
+            return None
+
+        loader = spec.loader
+        if not (hasattr(loader, 'get_code') and hasattr(loader, 'get_source')):
+            return spec
+        spec.loader = BreakpointLoader(loader, self)
+        return spec
@@ -0,0 +1,140 @@
+import sys
+import ast
+import types
+import inspect
+import hashlib
+import textwrap
+
+# A breakpoint's site records where it is in terms that survive the function
+# being redefined: the function's module and qualified name, and the line's
+# offset from the start of the function and its text. When the function is
+# defined again (by re-running a cell, or reloading a module), the line is
+# looked up by its text, starting from the old offset.
+
+ACCESSORS = ('fget', 'fset', 'fdel')
+
+def unwrap_function(value):
+    """
+    Returns the function behind a staticmethod, classmethod, or wrapper made
+    with functools.wraps, or None if value is not a function
+    """
+    if isinstance(value, (staticmethod, classmethod)):
+        value = value.__func__
+    seen = set()
+    while isinstance(getattr(value, '__wrapped__', None), types.FunctionType):
+        if id(value) in seen:
+            break
+        seen.add(id(value))
+        value = value.__wrapped__
+    if isinstance(value, types.FunctionType):
+        return value
+    return None
+
+def resolve_function(module, qualname, accessor=None):
+    """
+    Returns the function currently found in module under qualname (or the
+    given accessor of the property found there), or None
+    """
+    obj = module
+    for part in qualname.split('.'):
+        try:
+            obj = vars(obj).get(part)
+        except TypeError:
+            return None
+    if accessor is not None:
+        if not isinstance(obj, property):
+            return None
+        obj = getattr(obj, accessor)
+    return unwrap_function(obj)
+
+def locate_function(func):
+    """
+    Returns (module_name, qualname, accessor) under which func can be found
+    again after it is redefined, or None if it can't be reached from its
+    module (e.g. it is nested in another function)
+    """
+    module = sys.modules.get(func.__module__)
+    if module is None or '<locals>' in func.__qualname__:
+        return None
+    for accessor in (None,) + ACCESSORS:
+        if resolve_function(module, func.__qualname__, accessor) is func:
+            return func.__module__, func.__qualname__, accessor
+    return None
+
+def function_hash(func):
+    """
+    Returns a hash of the AST of a function's source, which ignores
+    formatting and comments, or None if the source is unavailable
+    """
+    try:
+        source = inspect.getsource(func)
+        tree = ast.parse(textwrap.dedent(source))
+    except (OSError, TypeError, SyntaxError):
+        return None
+    return hashlib.sha1(ast.dump(tree).encode()).hexdigest()
+
+def line_site(func, lineno):
+    """
+    Returns (offset, text) for a line of func, or (None, None) for the start
+    of the function
+    """
+    if lineno is None:
+        return None, None
+    try:
+        lines, start = inspect.getsourcelines(func)
+    except (OSError, TypeError):
+        return lineno - func.__code__.co_firstlineno, None
+    offset = lineno - start
+    text = lines[offset].strip() if 0 <= offset < len(lines) else None
+    return offset, text
+
+def nearest_line(lines, offset, text):
+    """
+    Returns the index of the line in lines with the given text that is
+    nearest to offset, or None. Without text, the offset is trusted.
+    """
+    if text is None:
+        return offset
+    matches = [i for i, line in enumerate(lines) if line.strip() == text]
+    if not matches:
+        return None
+    return min(matches, key=lambda i: abs(i - offset))
+
+def find_site(func, offset, text):
+    """
+    Returns the line number of a site in func: the line with the same text
+    nearest to the old offset, or None if there is no such line
+    """
+    try:
+        lines, start = inspect.getsourcelines(func)
+    except (OSError, TypeError):
+        return func.__code__.co_firstlineno + offset if text is None else None
+    index = nearest_line(lines, offset, text)
+    return None if index is None else start + index
+
+class TrackedFunction():
+    """
+    A function with breakpoints added by %break, with what is needed to
+    put them back when the function is redefined
+    """
+    def __init__(self, func, location):
+        self.location = location
+        # num -> (offset, text)
+        self.sites = {}
+        self.update(func)
+
+    def update(self, func):
+        self.func = func
+        self.code = func.__code__
+        self.firstlineno = func.__code__.co_firstlineno
+        self.source_hash = function_hash(func)
+
+    def is_unchanged(self, func):
+        """
+        Whether func has the same source, at the same position, as the
+        function that was instrumented (so its instrumented code can be reused)
+        """
+        return (self.source_hash is not None
+            and func.__code__.co_firstlineno == self.firstlineno
+            and func.__code__.co_freevars == self.code.co_freevars
+            and function_hash(func) == self.source_hash)
@@ -0,0 +1,168 @@
+import os
+import json
+import math
+import time
+import array
+import collections
+
+# Timestamps for %probe. perf_counter_ns (Python 3.7+) avoids a float
+# allocation per reading; before that, perf_counter's float seconds are used.
+if hasattr(time, 'perf_counter_ns'):
+    clock = time.perf_counter_ns
+    CLOCK_SECONDS = 1e-9
+else:
+    clock = time.perf_counter
+    CLOCK_SECONDS = 1.0
+
+def format_duration(seconds):
+    for unit, scale in (('s', 1.0), ('ms', 1e-3), ('us', 1e-6)):
+        if seconds >= scale:
+            return '{:.3g} {}'.format(seconds / scale, unit)
+    return '{:.3g} ns'.format(seconds / 1e-9)
+
+class LogHistogram():
+    """
+    Counts durations in buckets whose bounds grow by a factor of
+    2 ** (1 / SUBBUCKETS), from 1 ns up, in constant memory
+    """
+    SUBBUCKETS = 2
+    OCTAVES = 48 # up to about 3 days
+
+    def __init__(self):
+        self.counts = array.array('Q', [0]) * (self.OCTAVES * self.SUBBUCKETS)
+        self.reset()
+
+    def reset(self):
+        # In place, since hooks hold on to the bound add method
+        for index in range(len(self.counts)):
+            self.counts[index] = 0
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def bucket(self, seconds):
+        if seconds < 1e-9:
+            return 0
+        mantissa, exponent = math.frexp(seconds * 1e9)
+        index = (exponent - 1) * self.SUBBUCKETS + int((mantissa - 0.5) * 2 * self.SUBBUCKETS)
+        return min(index, len(self.counts) - 1)
+
+    def bucket_bounds(self, index):
+        return (2 ** (index / self.SUBBUCKETS) * 1e-9,
+            2 ** ((index + 1) / self.SUBBUCKETS) * 1e-9)
+
+    def add(self, seconds, frexp=math.frexp):
+        # bucket(), inlined: %stopwatch hooks call this for every sample
+        mantissa, exponent = frexp(seconds * 1e9)
+        index = (exponent - 2) * self.SUBBUCKETS + int(mantissa * 2 * self.SUBBUCKETS)
+        if not 0 <= index < len(self.counts):
+            index = 0 if index < 0 else len(self.counts) - 1
+        self.counts[index] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, q):
+        """
+        Returns the upper bound of the bucket holding the q-th percentile
+        (capped at the largest value seen)
+        """
+        if not self.count:
+            return None
+        rank = max(1, math.ceil(self.count * q / 100))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return min(self.bucket_bounds(index)[1], self.max)
+        return self.max
+
+    def summary(self):
+        if not self.count:
+            return 'no calls'
+        return '{} calls, mean {}, p50 {}, p99 {}, max {}'.format(self.count,
+            format_duration(self.total / self.count), format_duration(self.percentile(50)),
+            format_duration(self.percentile(99)), format_duration(self.max))
+
+    def format(self, width=40):
+        """
+        Returns the lines of a text histogram, from the smallest bucket used
+        to the largest
+        """
+        used = [index for index, count in enumerate(self.counts) if count]
+        if not used:
+            return []
+        top = max(self.counts)
+        lines = []
+        for index in range(used[0], used[-1] + 1):
+            low, high = self.bucket_bounds(index)
+            count = self.counts[index]
+            bar = '#' * (-(-count * width // top))
+            lines.append('{:>10} - {:<10} {:>8}  {}'.format(
+                format_duration(low), format_duration(high), count, bar))
+        return lines
+
+class Probe():
+    """
+    The start and end times (and thread) of the latest calls of one function,
+    recorded by the hooks of add_probe. Once capacity calls are kept, each
+    new call drops the oldest, so memory use stays constant.
+    """
+    def __init__(self, name, capacity=1 << 16):
+        self.name = name
+        # A bounded deque is a ring buffer whose append is a single C call.
+        # (Storing into preallocated arrays takes a call to claim a slot and
+        # a store per field, about three times the cost per call.)
+        self.buffer = collections.deque(maxlen=capacity)
+        self.record = self.buffer.append
+
+    def reset(self):
+        self.buffer.clear()
+
+    def calls(self):
+        """
+        Returns (start, end, thread) for each kept call, in the order they
+        returned, with times in seconds
+        """
+        return [(start * CLOCK_SECONDS, end * CLOCK_SECONDS, thread)
+            for start, end, thread in list(self.buffer)]
+
+    def histogram(self):
+        histogram = LogHistogram()
+        for start, end, thread in self.calls():
+            histogram.add(end - start)
+        return histogram
+
+class Stopwatch():
+    """
+    The times a function took from reaching one line to reaching another,
+    measured by the hooks of add_stopwatch
+    """
+    def __init__(self, number, func_name, start_lineno, stop_lineno):
+        self.number = number
+        self.name = '{}:{}-{}'.format(func_name, start_lineno, stop_lineno)
+        self.start_lineno = start_lineno
+        self.stop_lineno = stop_lineno
+        # The local variable holding the time line start_lineno was reached
+        self.local_name = '___xdbg_stopwatch_{}'.format(number)
+        self.histogram = LogHistogram()
+        self.add = self.histogram.add
+
+def write_chrome_trace(path, probes):
+    """
+    Writes the calls kept by probes as complete events in the Chrome trace
+    event format, which chrome://tracing and Perfetto can open
+    """
+    pid = os.getpid()
+    events = []
+    for probe in probes:
+        for start, end, thread in probe.calls():
+            events.append({'name': probe.name, 'ph': 'X', 'pid': pid, 'tid': thread,
+                'ts': start * 1e6, 'dur': (end - start) * 1e6})
+    events.sort(key=lambda event: event['ts'])
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ns'}, f)
+    os.replace(tmp_path, path)
+    return len(events)
@@ -0,0 +1,306 @@
+import os
+import json
+import mmap
+import numbers
+import operator
+import pickle
+import struct
+import collections
+
+# A trace is a directory with one file per column, plus columns.json which
+# describes them. Scalar columns are flat arrays of fixed-width little-endian
+# values, so they can be opened directly with e.g.
+#   numpy.memmap('trace/x.col', dtype='<f8', mode='r', shape=(rows,))
+# Object columns are stored as pickles concatenated into a heap file, together
+# with an array of int64 end offsets (one per row).
+
+SCALAR_FORMATS = collections.OrderedDict([
+    ('|b1', '?'),
+    ('<i8', 'q'),
+    ('<f8', 'd'),
+])
+
+def infer_dtype(value):
+    kind = None
+    if getattr(value, 'shape', None) == ():
+        # numpy scalar
+        kind = getattr(getattr(value, 'dtype', None), 'kind', None)
+
+    if isinstance(value, bool) or kind == 'b':
+        return '|b1'
+    elif isinstance(value, numbers.Integral) or kind in ('i', 'u'):
+        return '<i8'
+    elif isinstance(value, numbers.Real) or kind == 'f':
+        return '<f8'
+    else:
+        return 'object'
+
+class GrowableMap():
+    """
+    A file that is memory-mapped for writing, and grows as needed
+    """
+    def __init__(self, path, initial_size):
+        self.file = open(path, 'w+b')
+        self.size = 0
+        self.map = None
+        self.reserve(initial_size)
+
+    def reserve(self, size):
+        if size <= self.size:
+            return
+        size = max(size, 2 * self.size)
+        if self.map is not None:
+            self.map.close()
+        self.file.truncate(size)
+        self.map = mmap.mmap(self.file.fileno(), size)
+        self.size = size
+
+    def flush(self):
+        self.map.flush()
+
+    def close(self, used_size):
+        self.map.close()
+        self.file.truncate(used_size)
+        self.file.close()
+
+def convert_bool(value):
+    if value is True or value is False or infer_dtype(value) == '|b1':
+        return bool(value)
+    raise TypeError("Expected a bool, got {}".format(type(value).__name__))
+
+def convert_int(value):
+    value = operator.index(value)
+    # Checked here rather than left to struct.pack_into, so that a row is
+    # rejected before any of its columns are written
+    if not -2 ** 63 <= value < 2 ** 63:
+        raise OverflowError("{} does not fit into int64".format(value))
+    return value
+
+SCALAR_CONVERTERS = {
+    '|b1': convert_bool,
+    '<i8': convert_int,
+    '<f8': float,
+}
+
+class ScalarColumnWriter():
+    def __init__(self, path, name, dtype, capacity):
+        self.name = name
+        self.dtype = dtype
+        self.struct = struct.Struct('<' + SCALAR_FORMATS[dtype])
+        self.data = GrowableMap(os.path.join(path, name + '.col'),
+            capacity * self.struct.size)
+        self.convert = SCALAR_CONVERTERS[dtype]
+
+    def reserve(self, rows):
+        self.data.reserve(rows * self.struct.size)
+
+    def write(self, row, value):
+        # The caller is responsible for calling reserve() first
+        self.struct.pack_into(self.data.map, row * self.struct.size, value)
+
+    def flush(self):
+        self.data.flush()
+
+    def close(self, rows):
+        self.data.close(rows * self.struct.size)
+
+class ObjectColumnWriter():
+    def __init__(self, path, name, capacity):
+        self.name = name
+        self.dtype = 'object'
+        self.offsets = ScalarColumnWriter(path, name, '<i8', capacity)
+        self.heap = GrowableMap(os.path.join(path, name + '.heap'), capacity * 64)
+        self.heap_used = 0
+
+    def convert(self, value):
+        return pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+    def reserve(self, rows):
+        self.offsets.reserve(rows)
+
+    def write(self, row, data):
+        start = self.heap_used
+        self.heap.reserve(start + len(data))
+        self.heap.map[start:start + len(data)] = data
+        self.heap_used += len(data)
+        self.offsets.write(row, self.heap_used)
+
+    def flush(self):
+        self.offsets.flush()
+        self.heap.flush()
+
+    def close(self, rows):
+        self.offsets.close(rows)
+        self.heap.close(self.heap_used)
+
+class TraceFile():
+    """
+    Appends rows of captured values to a columnar trace on disk.
+
+    Column types are inferred from the first row unless given in dtypes:
+    '|b1', '<i8' and '<f8' are stored as fixed-width arrays, and anything else
+    as pickled objects. A row that does not fit the column types is rejected
+    as a whole with an exception.
+    """
+    def __init__(self, path, names, dtypes=None, capacity=4096):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.names = list(names)
+        self.dtypes = dtypes
+        self.capacity = capacity
+        self.columns = None
+        self.converters = None
+        self.writers = None
+        self.rows = 0
+        self.errors = 0
+        self.closed = False
+        self.write_meta()
+
+    def create_columns(self, values):
+        dtypes = self.dtypes
+        if dtypes is None:
+            dtypes = [infer_dtype(value) for value in values]
+
+        self.columns = []
+        for name, dtype in zip(self.names, dtypes):
+            if dtype == 'object':
+                column = ObjectColumnWriter(self.path, name, self.capacity)
+            else:
+                column = ScalarColumnWriter(self.path, name, dtype, self.capacity)
+            self.columns.append(column)
+        self.converters = [column.convert for column in self.columns]
+        self.writers = [column.write for column in self.columns]
+        self.write_meta()
+
+    def append(self, values):
+        if self.closed:
+            raise ValueError("Trace {} is closed".format(self.path))
+        if len(values) != len(self.names):
+            raise ValueError("Expected {} values, got {}".format(len(self.names), len(values)))
+
+        if self.columns is None:
+            self.create_columns(values)
+
+        row = self.rows
+        if row == self.capacity:
+            self.capacity *= 2
+            for column in self.columns:
+                column.reserve(self.capacity)
+
+        # Convert everything before writing, so that rows are never partial
+        converted = [convert(value) for convert, value in zip(self.converters, values)]
+        for write, value in zip(self.writers, converted):
+            write(row, value)
+        self.rows = row + 1
+
+    def write_meta(self):
+        meta = {
+            'rows': self.rows,
+            'columns': [{'name': name, 'dtype': None} for name in self.names],
+        }
+        if self.columns is not None:
+            meta['columns'] = [{'name': column.name, 'dtype': column.dtype}
+                for column in self.columns]
+
+        tmp_path = os.path.join(self.path, 'columns.json.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, os.path.join(self.path, 'columns.json'))
+
+    def flush(self):
+        if self.closed:
+            return
+        if self.columns is not None:
+            for column in self.columns:
+                column.flush()
+        self.write_meta()
+
+    def close(self):
+        if self.closed:
+            return
+        if self.columns is not None:
+            for column in self.columns:
+                column.close(self.rows)
+        self.write_meta()
+        self.closed = True
+
+# %% Reading traces back
+
+def map_file(path):
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return None
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+class ObjectColumn():
+    """
+    Read-only sequence of the objects in a column, unpickled on access
+    """
+    def __init__(self, path, name, rows):
+        self.offsets_map = map_file(os.path.join(path, name + '.col'))
+        self.heap_map = map_file(os.path.join(path, name + '.heap'))
+        self.offsets = memoryview(self.offsets_map or b'').cast('q')[:rows]
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, row):
+        if isinstance(row, slice):
+            return [self[i] for i in range(*row.indices(len(self)))]
+        if row < 0:
+            row += len(self)
+        start = self.offsets[row - 1] if row > 0 else 0
+        return pickle.loads(self.heap_map[start:self.offsets[row]])
+
+    def close(self):
+        self.offsets.release()
+        for m in (self.offsets_map, self.heap_map):
+            if m is not None:
+                m.close()
+
+class Trace():
+    """
+    A trace written by TraceFile, opened without reading it into memory.
+
+    trace[name] is a memoryview for scalar columns (numpy.asarray wraps it
+    without copying), and an ObjectColumn otherwise.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'columns.json')) as f:
+            meta = json.load(f)
+        self.rows = meta['rows']
+        self.dtypes = collections.OrderedDict(
+            (column['name'], column['dtype']) for column in meta['columns'])
+
+        self.maps = []
+        self.columns = collections.OrderedDict()
+        for name, dtype in self.dtypes.items():
+            if dtype is None:
+                continue
+            elif dtype == 'object':
+                self.columns[name] = ObjectColumn(path, name, self.rows)
+            else:
+                column_map = map_file(os.path.join(path, name + '.col'))
+                self.maps.append(column_map)
+                self.columns[name] = memoryview(column_map or b'').cast(
+                    SCALAR_FORMATS[dtype])[:self.rows]
+
+    def keys(self):
+        return self.dtypes.keys()
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def __len__(self):
+        return self.rows
+
+    def close(self):
+        for column in self.columns.values():
+            if isinstance(column, ObjectColumn):
+                column.close()
+            else:
+                column.release()
+        for column_map in self.maps:
+            if column_map is not None:
+                column_map.close()
@@ -465,7 +465,11 @@ class Code(object):
                     op += State(next_pos, cur_state.stack, cur_state.block_stack, cur_state.log),
 
                 elif o not in hasflow:
-                    if o in hasarg and not isinstance(arg, int):
+                    if o == NOP:
+                        # Only emitted by the peephole optimizer, so unknown
+                        # to stack_effect
+                        se = 0
+                    elif o in hasarg and not isinstance(arg, int):
                         se = stack_effect(o, 0)
                     else:
                         se = stack_effect(o, arg)
@@ -5,15 +5,75 @@ from IPython.core.inputtransformer import StatelessInputTransformer
 from IPython.core.splitinput import LineInfo
 from IPython.core.magic import (Magics, magics_class, line_magic,
                                 cell_magic, line_cell_magic)
-from .frame_tracker import FrameTracker
-from .breakpoint_hooks import BaseBreakpointTable, add_breakpoint, materialize_breakpoints
+from .frame_tracker import FrameTracker, NO_VALUE, CONTINUE
+from .breakpoint_hooks import (BaseBreakpointTable, add_breakpoint, add_logpoint,
+                               remove_logpoint, add_return_breakpoint, patch_line,
+                               has_table, has_step_gates, add_step_gates, remove_step_gates,
+                               add_exception_hook, add_memo_hook, get_arg_names,
+                               materialize_breakpoints, add_line_counters,
+                               remove_line_counters, add_probe, remove_probe,
+                               add_stopwatch, remove_stopwatch, add_watchpoint)
+from .logpoints import LogBuffer, LogError
+from .trace_file import TraceFile
+from .inspector import describe_locals
+from .memo import MemoCache, NO_KEY
+from .capture import CaptureStore, find_global_names, replay_call
+from .module_index import ModuleIndex
+from .definitions import compile_definitions, exec_definitions
+from .sites import (unwrap_function, locate_function, resolve_function, line_site,
+                    find_site, TrackedFunction)
+from .session import save_session, load_session, BreakpointFinder
+from .markers import MarkerFinder
+from .timing import Probe, Stopwatch, clock, CLOCK_SECONDS, write_chrome_trace
 import ast
 import types
 import importlib
+import gc
+import time
+import tempfile
+import threading
 
 def error(*args, **kwargs):
     print(*args, **kwargs, file=sys.stderr)
 
+def find_functions(obj):
+    """
+    Returns the functions defined directly in a module or class, including
+    the methods of classes defined in a module, the accessors of properties,
+    and the functions behind functools.wraps wrappers
+    """
+    res = []
+    if isinstance(obj, types.ModuleType):
+        for value in list(vars(obj).values()):
+            if getattr(value, '__module__', None) != obj.__name__:
+                continue
+            if isinstance(value, type):
+                res.extend(find_functions(value))
+                continue
+            value = unwrap_function(value)
+            if value is not None:
+                res.append(value)
+    else:
+        for value in list(vars(obj).values()):
+            if isinstance(value, property):
+                res.extend(accessor for accessor in (value.fget, value.fset, value.fdel)
+                    if isinstance(accessor, types.FunctionType))
+            elif isinstance(value, type):
+                # Nested classes, but not other classes that are attributes
+                if value.__qualname__.startswith(obj.__qualname__ + '.'):
+                    res.extend(find_functions(value))
+            else:
+                value = unwrap_function(value)
+                if value is not None:
+                    res.append(value)
+
+    # The same function can be reachable under several names
+    seen = set()
+    return [func for func in res if not (id(func) in seen or seen.add(id(func)))]
+
+def code_location(code):
+    return code.co_filename, code.co_firstlineno, code.co_name
+
 class BreakpointTable(BaseBreakpointTable):
     def __init__(self, debugger):
         self.debugger = debugger
@@ -22,23 +82,64 @@ class BreakpointTable(BaseBreakpointTable):
         self.b_enabled = {}
         self.b_temporary = {}
         self.b_ignore_count = {}
+        self.b_log_exprs = {}
+        self.log_buffer = LogBuffer()
+        self.b_traces = {}
+        self.b_catch_types = {}
+        self.b_memos = {}
+        self.b_captures = {}
+        self.b_lines = {}
+        # The function each breakpoint was added to
+        self.b_funcs = {}
+        # Breakpoints whose functions keep step gates while they are enabled
+        self.b_step_gates = set()
+        # (frame, min_lineno) while %next or %until is waiting for a line of
+        # that frame to be reached
+        self.stepping = None
+        # (frame, lineno) of the last line stepped to, whose breakpoint
+        # should not stop a second time
+        self.step_stop = None
 
-    def new_breakpoint(self, func, lineno):
+    def new_breakpoint(self, func, lineno, name=None):
         num = self.counter
         self.counter += 1
 
-        self.b_names[num] = "{}:{}".format(func.__name__, lineno)
+        if name is None:
+            name = "{}:{}".format(func.__name__, lineno)
+        self.b_names[num] = name
         self.b_enabled[num] = True
         self.b_temporary[num] = False
         self.b_ignore_count[num] = 0
+        self.b_lines[num] = lineno
+        self.b_funcs[num] = func
+
+        # Child processes forked from here on can relay hits back to us
+        self.debugger.frame_tracker.relay_forks()
 
         return num
 
+    def move_breakpoint(self, num, func, lineno):
+        self.b_names[num] = "{}:{}".format(func.__name__, lineno)
+        self.b_lines[num] = lineno
+        self.b_funcs[num] = func
+
     def remove_breakpoint(self, num):
         del self.b_names[num]
         del self.b_enabled[num]
         del self.b_temporary[num]
         del self.b_ignore_count[num]
+        self.b_log_exprs.pop(num, None)
+        self.b_catch_types.pop(num, None)
+        self.b_memos.pop(num, None)
+        self.b_captures.pop(num, None)
+        self.b_lines.pop(num, None)
+        func = self.b_funcs.pop(num, None)
+        trace = self.b_traces.pop(num, None)
+        if trace is not None:
+            trace.close()
+        if num in self.b_step_gates:
+            self.b_step_gates.remove(num)
+            self.sync_step_gates(func)
 
     def list_breakpoints(self):
         res = []
@@ -55,29 +156,270 @@ class BreakpointTable(BaseBreakpointTable):
                 self.b_temporary[num] = temporary
             if ignore_count is not None:
                 self.b_ignore_count[num] = ignore_count
+        if enabled is not None:
+            funcs = []
+            for num in breakpoints:
+                func = self.b_funcs.get(num)
+                if num in self.b_step_gates and not any(func is other for other in funcs):
+                    funcs.append(func)
+            for func in funcs:
+                self.sync_step_gates(func)
+
+    def sync_step_gates(self, func):
+        """
+        Add or remove the step gates of func, which it keeps for as long as
+        one of its breakpoints in b_step_gates is enabled
+        """
+        if not isinstance(func, types.FunctionType):
+            return
+        wanted = any(self.b_enabled[num] for num in self.b_step_gates
+            if self.b_funcs.get(num) is func)
+        if wanted == has_step_gates(self, func.__code__):
+            return
+        if wanted:
+            add_step_gates(self, func)
+        else:
+            remove_step_gates(self, func)
+        self.debugger.code_replaced(func)
 
     def breakpoint_exists(self, num):
         return num in self.b_names
 
-    def __call__(self, num, module_name, locals_dict):
+    def consume_hit(self, num):
         """
-        Called whenever a breakpoint is hit.
-        Returns a tuple (do_return, return_value)
+        Returns whether a hit of breakpoint num should take effect, counting
+        it against the ignore count
         """
         if not self.b_enabled.get(num, False):
-            return False, None
+            return False
 
         old_ignore_count = self.b_ignore_count[num]
         self.b_ignore_count[num] = max(0, old_ignore_count - 1)
-        if old_ignore_count > 0:
-            return False, None
+        return old_ignore_count == 0
 
-        res = self.debugger.frame_tracker.enter_frame(module_name, locals_dict, stack_skip=2)
-        if self.b_temporary[num]:
+    def stop(self, num, module_name, locals_dict, closure_dict=None, stack_skip=1):
+        lineno = self.b_lines.get(num)
+        res = self.debugger.frame_tracker.enter_frame(module_name, locals_dict,
+            closure_dict=closure_dict,
+            stack_skip=stack_skip + 1,
+            lineno=lineno if isinstance(lineno, int) else None)
+        if self.b_temporary.get(num, False):
             self.remove_breakpoint(num)
+        return res
+
+    def __call__(self, num, module_name, locals_dict, closure_dict=None):
+        """
+        Called whenever a breakpoint is hit.
+        Returns a tuple (do_return, return_value)
+        """
+        step_stop, self.step_stop = self.step_stop, None
+        if step_stop == (sys._getframe(1), self.b_lines.get(num)):
+            # Already stopped here by stepping
+            return False, None
+
+        if not self.consume_hit(num):
+            return False, None
+
+        res = self.stop(num, module_name, locals_dict, closure_dict, stack_skip=2)
+        if res is CONTINUE:
+            return False, None
+        if res is NO_VALUE:
+            res = None
+        return True, res
+
+    def step(self, lineno, module_name, locals_dict, closure_dict=None):
+        """
+        Called by the step gates of a function before each line, while
+        %next or %until is in progress. Returns a tuple
+        (do_return, return_value).
+        """
+        stepping = self.stepping
+        frame = sys._getframe(1)
+        if stepping is None or stepping[0] is not frame:
+            return False, None
+        if stepping[1] is not None and lineno < stepping[1]:
+            return False, None
+
+        self.stepping = None
+        self.step_stop = (frame, lineno)
+        del frame
+        res = self.debugger.frame_tracker.enter_frame(module_name, locals_dict,
+            closure_dict=closure_dict,
+            stack_skip=2,
+            lineno=lineno)
+        if res is CONTINUE:
+            return False, None
+        if res is NO_VALUE:
+            res = None
+        return True, res
+
+    def clear_stale_stepping(self):
+        """
+        Stop waiting for a line of a frame that has already returned
+        """
+        if self.stepping is None:
+            return
+        frame = sys._getframe()
+        while frame is not None:
+            if frame is self.stepping[0]:
+                return
+            frame = frame.f_back
+        self.stepping = None
+
+    def on_return(self, num, module_name, locals_dict, closure_dict=None):
+        """
+        Called before a function instrumented by %break func return returns,
+        with the pending value in locals_dict['__return__']. Returns a tuple
+        (do_replace, return_value), where a bare `return` keeps the value.
+        """
+        if not self.consume_hit(num):
+            return False, None
+
+        print('[xdbg] Returning: {!r}'.format(locals_dict.get('__return__')))
+        res = self.stop(num, module_name, locals_dict, closure_dict, stack_skip=2)
+        if res is NO_VALUE or res is CONTINUE:
+            return False, None
+        return True, res
 
+    def on_watch(self, num, name, module_name, locals_dict, closure_dict=None):
+        """
+        Called after a function instrumented by %watch assigns to the watched
+        variable. Returns a tuple (do_return, return_value).
+        """
+        if not self.consume_hit(num):
+            return False, None
+
+        print('[xdbg] {} = {!r}'.format(name, locals_dict.get(name)))
+        res = self.stop(num, module_name, locals_dict, closure_dict, stack_skip=2)
+        if res is NO_VALUE or res is CONTINUE:
+            return False, None
         return True, res
 
+    def catch(self, num, module_name, locals_dict, closure_dict=None):
+        """
+        Called when an exception propagates out of a function instrumented by
+        %catch. Returns a tuple (do_return, return_value), where not returning
+        re-raises the exception.
+        """
+        exc_type, exc, tb = sys.exc_info()
+        catch_type = self.b_catch_types.get(num)
+        if catch_type is None or not isinstance(exc, catch_type):
+            return False, None
+
+        # Only stop in the innermost instrumented function, which is where
+        # the exception was raised (or where it entered the instrumented code)
+        if self.caught_below(num, exc, tb):
+            return False, None
+
+        if not self.consume_hit(num):
+            return False, None
+
+        print('[xdbg] Caught {}: {}'.format(type(exc).__name__, exc))
+        res = self.stop(num, module_name, locals_dict, closure_dict, stack_skip=2)
+        if res is NO_VALUE or res is CONTINUE:
+            return False, None
+        return True, res
+
+    def caught_below(self, num, exc, tb):
+        """
+        Returns whether exc went through another function with a matching
+        %catch hook on its way up to the frame at the head of tb, or through
+        another such hook in that frame
+        """
+        frame = tb.tb_frame
+        # The hooks of one function are nested in the order they were added,
+        # so the ones that ran before this one have lower numbers
+        if any(other < num for other in self.catch_hooks(frame.f_code, exc)):
+            return True
+
+        tb = tb.tb_next
+        while tb is not None:
+            # Below a frame that isn't its caller, the traceback is left over
+            # from an earlier raise of the same exception instance. Finished
+            # generator frames have no f_back.
+            f_back = tb.tb_frame.f_back
+            if not (tb.tb_frame is frame or f_back is frame or f_back is None):
+                break
+            frame = tb.tb_frame
+            if self.catch_hooks(frame.f_code, exc):
+                return True
+            tb = tb.tb_next
+        return False
+
+    def catch_hooks(self, code, exc):
+        """
+        Returns the numbers of the %catch hooks in code that match exc
+        """
+        if 'catch' not in code.co_names or not any(const is self for const in code.co_consts):
+            return []
+        return [const for const in code.co_consts
+            if type(const) is int and isinstance(exc, self.b_catch_types.get(const, ()))]
+
+    def memo_lookup(self, num, locals_dict):
+        """
+        Called on entry to a function memoized by %memo. Returns a tuple
+        (hit, value), where value is the key to pass to memo_store on a miss.
+        """
+        memo = self.b_memos.get(num)
+        if memo is None or not self.consume_hit(num):
+            return False, NO_KEY
+
+        key = memo.make_key(locals_dict)
+        if key is NO_KEY:
+            return False, NO_KEY
+        hit, value = memo.lookup(key)
+        if hit:
+            return True, value
+        return False, key
+
+    def memo_store(self, value, num, key):
+        """
+        Called with the return value of a memoized function, which it passes
+        through
+        """
+        memo = self.b_memos.get(num)
+        if memo is not None and key is not NO_KEY:
+            memo.store(key, value)
+        return value
+
+    def capture(self, num, values):
+        """
+        Called on entry to a function instrumented by %capture, with its
+        locals (which are just the arguments at that point)
+        """
+        store = self.b_captures.get(num)
+        if store is not None and not store.replaying and self.consume_hit(num):
+            store.append(values[0])
+
+    def capture_error(self, num):
+        store = self.b_captures.get(num)
+        if store is not None:
+            store.errors += 1
+
+    def log(self, num, values):
+        """
+        Called whenever a logpoint is hit, with the values of its expressions
+        """
+        if self.consume_hit(num):
+            self.log_buffer.append(num, values)
+
+    def log_error(self, num):
+        self.log(num, LogError(sys.exc_info()[1]))
+
+    def record(self, num, values):
+        """
+        Called whenever a recording breakpoint is hit, with the values of the
+        recorded variables
+        """
+        trace = self.b_traces.get(num)
+        if trace is not None and self.consume_hit(num):
+            trace.append(values)
+
+    def record_error(self, num):
+        trace = self.b_traces.get(num)
+        if trace is not None:
+            trace.errors += 1
+
 @magics_class
 class Debugger(Magics):
     def __init__(self, shell):
@@ -87,9 +429,42 @@ class Debugger(Magics):
         self.frame_tracker = FrameTracker(self.shell)
         self.breakpoint_table = BreakpointTable(self)
 
+        # Functions changed by %patchline, mapped to their original code and
+        # the patches applied so far
+        self.patches = {}
+
+        # Functions with line counters added by %heatmap, mapped to
+        # (linenos, counts)
+        self.heatmaps = {}
+
+        # Functions timed by %probe, mapped to their timing.Probe
+        self.probes = {}
+
+        # Stopwatches added by %stopwatch, by number, with their functions
+        self.stopwatches = {}
+        self.stopwatch_counter = 0
+
         # Initialize magics
-        self.path_mapping = {}
+        # Source paths of loaded modules, for %scope path/to/file.py
+        self.path_mapping = ModuleIndex()
         self.shell.register_magics(self)
+        self.shell.events.register('post_execute', self.breakpoint_table.clear_stale_stepping)
+
+        # (module_name, qualname, accessor) -> TrackedFunction, for putting
+        # breakpoints back into functions that are redefined
+        self.tracked_functions = {}
+        self.shell.events.register('post_execute', self.reattach_breakpoints)
+
+        # Breakpoints loaded by %bpload: the ones in modules that aren't
+        # imported yet are added by the finder during the import, and the
+        # ones whose function doesn't exist yet are retried after each cell
+        self.session_finder = BreakpointFinder(self.breakpoint_table, self.on_session_module_loaded)
+        self.waiting_records = []
+        self.shell.events.register('post_execute', self.apply_waiting_records)
+
+        # Turns ___xdbg_breakpoint_here markers into breakpoints as modules
+        # are imported, while enabled by %markers on
+        self.marker_finder = MarkerFinder(self.breakpoint_table, self.on_markers_loaded)
 
     @property
     def main_module(self):
@@ -118,38 +493,232 @@ class Debugger(Magics):
                   '(temp)' if b_temporary else '')
 
     @line_magic
-    def makescope(self, name):
+    def makescope(self, args):
         """
-        Import a module without running the code inside
+        Import a module without running the code inside. With -d, run only
+        its imports, def and class statements, and assignments of literals,
+        so that its functions are usable without its expensive top-level
+        code. Running %makescope -d again picks up changes to the file.
         """
-        if name in sys.modules:
+        args = args.split()
+        definitions = bool(args) and args[0] == '-d'
+        if definitions:
+            args = args[1:]
+        if len(args) != 1:
+            return error("Syntax: %makescope [-d] module")
+        name = args[0]
+
+        module = sys.modules.get(name)
+        if module is not None and not (definitions
+                and getattr(module, '__xdbg_definitions__', False)):
             return
         spec = importlib.util.find_spec(name)
-        sys.modules[name] = importlib.util.module_from_spec(spec)
+        if spec is None:
+            return error("Module not found: {}".format(name))
+        if not definitions:
+            sys.modules[name] = importlib.util.module_from_spec(spec)
+            return
+
+        if not (spec.has_location and spec.origin.endswith('.py')):
+            return error("No source for module: {}".format(name))
+        start = time.perf_counter()
+        try:
+            codes = compile_definitions(spec.origin)
+        except (OSError, SyntaxError) as e:
+            return error("Could not read {}: {}".format(spec.origin, e))
+
+        if module is None:
+            module = importlib.util.module_from_spec(spec)
+            module.__xdbg_definitions__ = True
+            sys.modules[name] = module
+        failed = exec_definitions(codes, module.__dict__)
+        elapsed = time.perf_counter() - start
+
+        print('Defined {} ({} statements in {:.3f} s)'.format(name, len(codes) - len(failed), elapsed))
+        for lineno, e in failed:
+            error('  line {}: {}: {}'.format(lineno, type(e).__name__, e))
 
     @line_magic
     def scope(self, line):
         # TODO(nikita): do I want %scope to accept import specifiers, or names
         # of global variables?
 
-        if line.endswith('.py'):
-            return error("Scope accepts module names, not file paths")
-
+        line = line.strip()
         if not line or line == "__main__":
             self.frame_tracker.enter_module(self.main_module)
         elif line in sys.modules:
             self.frame_tracker.enter_module(sys.modules[line])
+        elif line.endswith('.py') or os.sep in line or (os.altsep and os.altsep in line):
+            module = self.path_mapping.lookup(line)
+            if module is None:
+                return error("No loaded module for file: {}".format(line))
+            self.frame_tracker.enter_module(module)
         else:
             return error("Module not found: {}".format(line))
 
+    @line_magic
+    def threads(self, line):
+        """
+        List breakpoint frames parked by other threads and child processes.
+
+        %threads --auto: from now on, enter parked frames whenever the kernel
+        is running a top-level cell, pausing the cell until they return (e.g.
+        for cells that wait for the threads). %threads --no-auto turns it off.
+        """
+        args = line.split()
+        if args in (['--auto'], ['--no-auto']):
+            enabled = args[0] == '--auto'
+            if not self.frame_tracker.set_auto_enter(enabled):
+                return error("%threads --auto needs SIGUSR2 and the shell on the main thread")
+            print('Entering parked frames automatically is {}'.format('on' if enabled else 'off'))
+            return
+        elif args:
+            return error("Syntax: %threads [--auto|--no-auto]")
+
+        parked = self.frame_tracker.list_parked_threads()
+        if not parked:
+            print('No parked threads')
+            return
+
+        print("Parked threads:")
+        for num, thread_name, frame_name in parked:
+            print('{}\t{}\t{}'.format(num, thread_name, frame_name))
+
+    @line_magic
+    def switch(self, line):
+        """
+        Enter the breakpoint frame of a parked thread or child process
+        """
+        try:
+            num = int(line)
+        except ValueError:
+            return error("Syntax: %switch num")
+
+        if not self.frame_tracker.switch_thread(num):
+            return error("Invalid parked thread number:", num)
+
+    def traceback_frames(self):
+        """
+        Returns the frames of sys.last_traceback as (frame, lineno) pairs,
+        outermost first, without the frames of IPython and xdbg that lead up
+        to user code
+        """
+        frames = []
+        tb = getattr(sys, 'last_traceback', None)
+        while tb is not None:
+            frames.append((tb.tb_frame, tb.tb_lineno))
+            tb = tb.tb_next
+
+        while frames:
+            module_name = frames[0][0].f_globals.get('__name__', '')
+            if not module_name.startswith(('IPython.', 'xdbg.')):
+                break
+            frames.pop(0)
+        return frames
+
+    def find_frame_closure(self, frame):
+        """
+        Returns the cells of the function that ran frame, or None if they
+        can't be told apart from those of other functions sharing its code
+        (closures made by the same factory)
+        """
+        code = frame.f_code
+        f_locals = frame.f_locals
+        candidates = {}
+        for obj in gc.get_referrers(code):
+            if not (isinstance(obj, types.FunctionType) and obj.__code__ is code
+                    and obj.__closure__ is not None):
+                continue
+            try:
+                matches = all(cell.cell_contents is f_locals.get(name, NO_VALUE)
+                    for name, cell in zip(code.co_freevars, obj.__closure__))
+            except ValueError:
+                # An empty cell
+                matches = False
+            if matches:
+                candidates[tuple(map(id, obj.__closure__))] = obj.__closure__
+        if len(candidates) != 1:
+            return None
+        return list(candidates.values())[0]
+
+    @line_magic
+    def postmortem(self, args):
+        """
+        Enter the scope of a frame from the last traceback, without re-running
+        the code that failed
+        """
+        frames = self.traceback_frames()
+        if not frames:
+            return error("No traceback to inspect")
+
+        args = args.strip()
+        if args == '?':
+            for i, (frame, lineno) in enumerate(frames):
+                print('{}\t<{}>.{}\t{}:{}'.format(i,
+                    frame.f_globals.get('__name__'), frame.f_code.co_name,
+                    frame.f_code.co_filename, lineno))
+            return
+
+        if not args:
+            num = len(frames) - 1
+        else:
+            try:
+                num = int(args)
+            except ValueError:
+                return error("Syntax: %postmortem [N|?]")
+            if not 0 <= num < len(frames):
+                return error("Invalid frame number:", num)
+
+        frame, lineno = frames[num]
+        code = frame.f_code
+        module_name = frame.f_globals.get('__name__')
+
+        # The frame's own cells are gone, but the cells it closed over can
+        # still be reached through the function object, and writing to them
+        # affects later calls
+        closure_dict = {}
+        if code.co_freevars:
+            closure = self.find_frame_closure(frame)
+            if closure is None:
+                print('[xdgb] Warning: nonlocals copied by value')
+            else:
+                closure_dict = dict(zip(code.co_freevars, closure))
+
+        self.frame_tracker.enter_frame(module_name, dict(frame.f_locals),
+            frame_name='<{}>.{} (post-mortem, line {})'.format(module_name, code.co_name, lineno),
+            closure_dict=closure_dict)
+
     @line_magic('break')
     def break_(self, args, temporary=False):
+        """
+        %break [-s] func [lineno], %break [-s] module_or_class *, or
+        %break func return [if cond]. With -s, the function is also set up
+        for %next and %until, which otherwise only works from the call after
+        the first %next. The function keeps the step gates this adds for as
+        long as the breakpoint is enabled.
+        """
+        parts = args.split(None, 1)
+        step_gates = bool(parts) and parts[0] == '-s'
+        if step_gates:
+            args = parts[1] if len(parts) == 2 else ''
+
+        parts = args.split(None, 2)
+        if len(parts) >= 2 and parts[1] == 'return':
+            if step_gates:
+                return error("Syntax: %break func return [if cond]")
+            return self.break_return(parts[0], parts[2] if len(parts) == 3 else None,
+                temporary=temporary)
+
         args = args.split()
 
         if len(args) == 0:
+            if step_gates:
+                return error("Syntax: %break [-s] func [lineno]")
             self.print_breakpoints()
+        elif len(args) == 2 and args[1] == '*':
+            return self.break_all(args[0], temporary=temporary, step_gates=step_gates)
         elif len(args) > 2:
-            return error("Syntax: %break [func [lineno]]")
+            return error("Syntax: %break [-s] [func [lineno]]")
         else:
             try:
                 func = self.frame_tracker.eval(args[0])
@@ -157,7 +726,10 @@ class Debugger(Magics):
                 return error("Not found: {}".format(args[0]))
 
             if len(args) == 1:
-                num = add_breakpoint(self.breakpoint_table, func)
+                num = add_breakpoint(self.breakpoint_table, func, step_gates=step_gates)
+                if step_gates:
+                    self.breakpoint_table.b_step_gates.add(num)
+                self.track_breakpoint(func, num)
                 self.breakpoint_table.modify_breakpoints([num], temporary=temporary)
                 print('New breakpoint', num)
             elif len(args) == 2:
@@ -172,14 +744,1130 @@ class Debugger(Magics):
                         print('{}  '.format(i), line, end='')
                     print()
                 else:
-                    num = add_breakpoint(self.breakpoint_table, func, lineno)
+                    num = add_breakpoint(self.breakpoint_table, func, lineno,
+                        step_gates=step_gates)
+                    if step_gates:
+                        self.breakpoint_table.b_step_gates.add(num)
+                    self.track_breakpoint(func, num, lineno)
                     self.breakpoint_table.modify_breakpoints([num], temporary=temporary)
                     print('New breakpoint', num)
 
+    def break_all(self, name, temporary=False, step_gates=False):
+        """
+        Add a breakpoint at the start of every function in a module or class
+        """
+        if name in sys.modules:
+            obj = sys.modules[name]
+        else:
+            try:
+                obj = self.frame_tracker.eval(name)
+            except:
+                return error("Not found: {}".format(name))
+        if not isinstance(obj, (types.ModuleType, type)):
+            return error("Not a module or class: {}".format(name))
+
+        funcs = find_functions(obj)
+        if not funcs:
+            return error("No functions found in {}".format(name))
+
+        start = time.perf_counter()
+        nums = []
+        failed = []
+        for func in funcs:
+            counter = self.breakpoint_table.counter
+            try:
+                num = add_breakpoint(self.breakpoint_table, func, step_gates=step_gates)
+            except Exception:
+                failed.append(func)
+                # Don't leave behind a breakpoint whose code was never installed
+                for num in range(counter, self.breakpoint_table.counter):
+                    self.breakpoint_table.remove_breakpoint(num)
+                continue
+            if step_gates:
+                self.breakpoint_table.b_step_gates.add(num)
+            self.track_breakpoint(func, num)
+            nums.append(num)
+        elapsed = time.perf_counter() - start
+
+        if nums:
+            self.breakpoint_table.modify_breakpoints(nums, temporary=temporary)
+            print('New breakpoints {}-{} ({} functions instrumented in {:.3f} s)'.format(
+                nums[0], nums[-1], len(nums), elapsed))
+        if failed:
+            error('Could not instrument:', ', '.join(func.__qualname__ for func in failed))
+
+    def code_replaced(self, func):
+        """
+        Called when xdbg replaces the code of func in place, so that
+        reattach_breakpoints doesn't take it for a redefinition
+        """
+        for tracked in self.tracked_functions.values():
+            if tracked.func is func:
+                tracked.code = func.__code__
+
+    def track_breakpoint(self, func, num, lineno=None):
+        """
+        Remember where breakpoint num is, so that it can be put back if func
+        is redefined
+        """
+        if not isinstance(func, types.FunctionType):
+            return
+        location = locate_function(func)
+        if location is None:
+            return
+        tracked = self.tracked_functions.get(location)
+        if tracked is None or tracked.func is not func:
+            tracked = self.tracked_functions[location] = TrackedFunction(func, location)
+        tracked.code = func.__code__
+        tracked.sites[num] = line_site(func, lineno)
+
+    def reattach_breakpoints(self):
+        """
+        Put breakpoints back into functions that were redefined since the
+        last cell: by re-running the cell that defines them, reloading their
+        module, or having their code replaced in place (as autoreload does)
+        """
+        table = self.breakpoint_table
+        for location, tracked in list(self.tracked_functions.items()):
+            for num in [num for num in tracked.sites if not table.breakpoint_exists(num)]:
+                del tracked.sites[num]
+            if not tracked.sites:
+                del self.tracked_functions[location]
+                continue
+
+            module_name, qualname, accessor = location
+            module = sys.modules.get(module_name)
+            func = resolve_function(module, qualname, accessor) if module is not None else None
+            if func is None or (func is tracked.func and has_table(table, func.__code__)):
+                continue
+
+            if tracked.is_unchanged(func):
+                # The instrumented code still matches the source
+                func.__code__ = tracked.code
+                tracked.func = func
+                print('[xdbg] Kept breakpoints {} in {}'.format(
+                    ', '.join(str(num) for num in sorted(tracked.sites)), qualname))
+                continue
+
+            step_gates = any(num in table.b_step_gates and table.b_enabled[num]
+                for num in tracked.sites)
+            moved = []
+            lost = []
+            sites = sorted(tracked.sites.items(), key=lambda item: -1 if item[1][0] is None else item[1][0])
+            for num, (offset, text) in sites:
+                lineno = None if offset is None else find_site(func, offset, text)
+                if offset is not None and lineno is None:
+                    lost.append(num)
+                    continue
+                try:
+                    add_breakpoint(table, func, lineno, step_gates=step_gates, num=num)
+                except ValueError:
+                    lost.append(num)
+                    continue
+                tracked.sites[num] = line_site(func, lineno)
+                moved.append(num)
+
+            for num in lost:
+                del tracked.sites[num]
+                table.remove_breakpoint(num)
+            tracked.update(func)
+
+            if moved:
+                print('[xdbg] Reattached breakpoints {} to {}'.format(
+                    ', '.join(str(num) for num in moved), qualname))
+            if lost:
+                error('[xdbg] Removed breakpoints {}: their lines are gone from {}'.format(
+                    ', '.join(str(num) for num in lost), qualname))
+
+    def session_records(self):
+        table = self.breakpoint_table
+        records = []
+        for location, tracked in sorted(self.tracked_functions.items(),
+                key=lambda item: (item[0][0], item[0][1], item[0][2] or '')):
+            module_name, qualname, accessor = location
+            for num, (offset, text) in sorted(tracked.sites.items()):
+                if not table.breakpoint_exists(num):
+                    continue
+                records.append({
+                    'module': module_name,
+                    'qualname': qualname,
+                    'accessor': accessor,
+                    'firstlineno': tracked.firstlineno,
+                    'offset': offset,
+                    'text': text,
+                    'enabled': table.b_enabled[num],
+                    'temporary': table.b_temporary[num],
+                    'ignore_count': table.b_ignore_count[num],
+                })
+        return records
+
+    @line_magic
+    def bpsave(self, args):
+        """
+        Save the breakpoints added by %break to a file, for %bpload to add
+        them again after the kernel restarts
+        """
+        path = args.strip()
+        if not path:
+            return error("Syntax: %bpsave path")
+        records = self.session_records()
+        try:
+            save_session(path, records)
+        except OSError as e:
+            return error("Could not save {}: {}".format(path, e))
+        print('Saved {} breakpoints to {}'.format(len(records), path))
+
+    @line_magic
+    def bpload(self, args):
+        """
+        Add the breakpoints saved by %bpsave. Breakpoints in modules that
+        aren't imported yet are added while the module is imported, and ones
+        in functions that don't exist yet (e.g. defined by a cell that hasn't
+        run) once they are defined.
+        """
+        path = args.strip()
+        if not path:
+            return error("Syntax: %bpload path")
+        try:
+            records = load_session(path)
+        except (OSError, ValueError, KeyError) as e:
+            return error("Could not load {}: {}".format(path, e))
+
+        added = []
+        importing = 0
+        waiting = 0
+        for record in records:
+            module = sys.modules.get(record['module'])
+            if module is None:
+                self.session_finder.add(record)
+                importing += 1
+                continue
+            # Records whose line is gone (-1) were already reported
+            num = self.apply_record(module, record)
+            if num is None:
+                self.waiting_records.append(record)
+                waiting += 1
+            elif num >= 0:
+                added.append(num)
+
+        if added:
+            print('New breakpoints', ', '.join(str(num) for num in added))
+        if importing:
+            print('{} breakpoints will be added when their modules are imported'.format(importing))
+        if waiting:
+            print('{} breakpoints will be added when their functions are defined'.format(waiting))
+
+    def apply_record(self, module, record, num=None, lineno=None):
+        """
+        Add a saved breakpoint to its function in module (unless num is
+        given, when the breakpoint was already added to the function's code
+        as lineno). Returns the breakpoint number, None if the function
+        doesn't exist (yet), or -1 if its line is gone.
+        """
+        func = resolve_function(module, record['qualname'], record['accessor'])
+        if func is None:
+            return None
+        if num is None:
+            lineno = None
+            if record['offset'] is not None:
+                lineno = find_site(func, record['offset'], record['text'])
+            try:
+                if record['offset'] is not None and lineno is None:
+                    raise ValueError("line not found")
+                num = add_breakpoint(self.breakpoint_table, func, lineno)
+            except ValueError:
+                error('[xdbg] Could not add saved breakpoint in {}.{}: line {!r} is gone'.format(
+                    record['module'], record['qualname'], record['text']))
+                return -1
+
+        # Added to the code before the function existed, with a stand-in
+        self.breakpoint_table.b_funcs[num] = func
+        self.track_breakpoint(func, num, lineno)
+        self.breakpoint_table.modify_breakpoints([num], enabled=record['enabled'],
+            temporary=record['temporary'], ignore_count=record['ignore_count'])
+        return num
+
+    def on_session_module_loaded(self, module, added, remaining):
+        nums = []
+        for num, lineno, record in added:
+            self.apply_record(module, record, num, lineno)
+            nums.append(num)
+        for record in remaining:
+            num = self.apply_record(module, record)
+            if num is None:
+                self.waiting_records.append(record)
+            elif num >= 0:
+                nums.append(num)
+        if nums:
+            print('[xdbg] New breakpoints {} in {}'.format(', '.join(str(num) for num in nums),
+                module.__name__))
+
+    def apply_waiting_records(self):
+        if not self.waiting_records:
+            return
+        waiting = []
+        for record in self.waiting_records:
+            module = sys.modules.get(record['module'])
+            num = None if module is None else self.apply_record(module, record)
+            if num is None:
+                waiting.append(record)
+            elif num >= 0:
+                print('[xdbg] New breakpoint {} in {}'.format(num, record['qualname']))
+        self.waiting_records = waiting
+
+    @line_magic
+    def markers(self, args):
+        """
+        %markers on|off: while on, a line of just ___xdbg_breakpoint_here in a
+        function of a module imported afterwards becomes a breakpoint.
+        Instrumented modules are cached on disk, so importing them again
+        skips the bytecode rewriting.
+        """
+        args = args.split()
+        finder = self.marker_finder
+        if not args:
+            print('Breakpoint markers are {} (cache {}: {} hits, {} misses)'.format(
+                'on' if finder.installed else 'off', finder.cache.path,
+                finder.cache.hits, finder.cache.misses))
+        elif args == ['on']:
+            finder.install()
+        elif args == ['off']:
+            finder.uninstall()
+        else:
+            return error("Syntax: %markers [on|off]")
+
+    def on_markers_loaded(self, module_name, nums):
+        if nums:
+            print('[xdbg] New breakpoints {} at markers in {}'.format(
+                ', '.join(str(num) for num in nums), module_name))
+
+    def start_stepping(self, min_lineno=None):
+        """
+        Continue from the current breakpoint, and stop again at the next line
+        of the same call that is numbered min_lineno or higher (or any line,
+        if min_lineno is None)
+        """
+        frame = self.frame_tracker.frames[-1]
+        python_frame = frame.python_frame
+        if frame.temporary or python_frame is None:
+            return error("Not stopped at a breakpoint in this thread")
+        table = self.breakpoint_table
+        if not has_step_gates(table, python_frame.f_code):
+            # The running code can't be replaced, but later calls can step.
+            # The breakpoints of the function then keep step gates in it, as
+            # if they had been added with %break -s.
+            code = python_frame.f_code
+            location = code_location(code)
+            nums = [num for num, func in table.b_funcs.items()
+                if hasattr(func, '__code__') and code_location(func.__code__) == location]
+            running = [obj for obj in gc.get_referrers(code)
+                if isinstance(obj, types.FunctionType) and obj.__code__ is code]
+            for num in nums:
+                if not isinstance(table.b_funcs[num], types.FunctionType) and running:
+                    # Added to the code before the function existed (by
+                    # %bpload or a marker)
+                    table.b_funcs[num] = running[0]
+            funcs = []
+            for num in nums:
+                func = table.b_funcs[num]
+                if isinstance(func, types.FunctionType) and not any(func is other for other in funcs):
+                    funcs.append(func)
+            if not funcs:
+                return error("Can't step in {}: use %break -s to set up stepping".format(
+                    code.co_name))
+            table.b_step_gates.update(nums)
+            for func in funcs:
+                table.sync_step_gates(func)
+            return error("Can't step in this call of {}: stepping is set up from its next"
+                " call (or use %break -s)".format(funcs[0].__qualname__))
+
+        self.breakpoint_table.stepping = (python_frame, min_lineno)
+        self.frame_tracker.exit_frame(CONTINUE)
+
+    @line_magic('next')
+    def next_(self, args):
+        """
+        Continue to the next line of the function stopped at
+        """
+        return self.start_stepping()
+
+    @line_magic
+    def until(self, args):
+        """
+        Continue until a line numbered lineno or higher is reached in the
+        function stopped at. Without lineno, continue until a line past the
+        current one, e.g. to finish a loop.
+        """
+        args = args.strip()
+        if args:
+            try:
+                lineno = int(args)
+            except ValueError:
+                return error("Syntax: %until [lineno]")
+        else:
+            frame = self.frame_tracker.frames[-1]
+            if frame.temporary:
+                return error("Not stopped at a breakpoint in this thread")
+            if frame.lineno is None:
+                return error("Current line unknown, use %until lineno")
+            lineno = frame.lineno + 1
+        return self.start_stepping(lineno)
+
+    def break_return(self, func_name, cond=None, temporary=False):
+        """
+        Stop before every return in a function, with the pending value in
+        __return__. `return value` at the breakpoint replaces it.
+        """
+        if cond is not None:
+            if not cond.startswith('if '):
+                return error("Syntax: %break func return [if cond]")
+            cond = cond[3:].strip()
+
+        func = self.find_function(func_name)
+        if func is None:
+            return
+
+        try:
+            num = add_return_breakpoint(self.breakpoint_table, func, cond)
+        except (SyntaxError, ValueError) as e:
+            return error("Could not add breakpoint:", e)
+        self.breakpoint_table.modify_breakpoints([num], temporary=temporary)
+        if cond is not None:
+            self.breakpoint_table.b_names[num] += ' if {}'.format(cond)
+        print('New breakpoint', num)
+
+    @line_magic
+    def watch(self, args):
+        """
+        %watch func var [if cond]: stop whenever func assigns to its local
+        variable var (and cond, evaluated in the function's scope, is true).
+        Only the assignments to var are instrumented, so the rest of the
+        function runs at full speed. A bare `return` continues, while
+        `return value` makes the function return value.
+        """
+        parts = args.split(None, 2)
+        cond = None
+        if len(parts) == 3:
+            if not parts[2].startswith('if '):
+                return error("Syntax: %watch func var [if cond]")
+            cond = parts[2][3:].strip()
+        elif len(parts) != 2:
+            return error("Syntax: %watch func var [if cond]")
+
+        func = self.find_function(parts[0])
+        if func is None:
+            return
+        try:
+            num = add_watchpoint(self.breakpoint_table, func, parts[1], cond)
+        except (SyntaxError, ValueError) as e:
+            return error("Could not add watchpoint:", e)
+        if cond is not None:
+            self.breakpoint_table.b_names[num] += ' if {}'.format(cond)
+        print('New breakpoint', num)
+
+    @line_magic
+    def patchline(self, args):
+        """
+        Permanently replace one line of a function with new code, compiled in
+        the function's scope. %unpatch restores the original function.
+        """
+        args = args.split(None, 2)
+        if not args:
+            if not self.patches:
+                print('No patched functions')
+                return
+            print("Patched functions:")
+            for func, patch in self.patches.items():
+                for lineno, source in sorted(patch['lines'].items()):
+                    print('{}:{}\t{}'.format(func.__qualname__, lineno, source))
+            return
+
+        if len(args) != 3:
+            return error("Syntax: %patchline func lineno source")
+
+        func = self.find_function(args[0])
+        if func is None:
+            return
+
+        try:
+            lineno = int(args[1])
+        except ValueError:
+            return error("Invalid line number:", args[1])
+
+        original_code = func.__code__
+        try:
+            patch_line(func, lineno, args[2])
+        except (SyntaxError, ValueError) as e:
+            return error("Could not patch:", e)
+
+        patch = self.patches.setdefault(func, {'original': original_code, 'lines': {},
+            'first_breakpoint': self.breakpoint_table.counter,
+            'heatmap': self.heatmaps.get(func), 'probe': self.probes.get(func),
+            'stopwatches': {num: entry for num, entry in self.stopwatches.items()
+                if entry[0] is func}})
+        patch['lines'][lineno] = args[2]
+        print('Patched {}:{}'.format(func.__qualname__, lineno))
+
+    @line_magic
+    def unpatch(self, args):
+        """
+        Undo all %patchline changes to a function. Breakpoints, heatmaps,
+        probes and stopwatches added since the first patch are removed along
+        with them.
+        """
+        func = self.find_function(args.strip())
+        if func is None:
+            return
+        patch = self.patches.pop(func, None)
+        if patch is None:
+            return error("Not patched:", args)
+        func.__code__ = patch['original']
+
+        table = self.breakpoint_table
+        removed = sorted(num for num, bp_func in table.b_funcs.items()
+            if bp_func is func and num >= patch['first_breakpoint'])
+        for num in removed:
+            table.remove_breakpoint(num)
+        # Otherwise reattach_breakpoints would take the restored code for a
+        # redefinition, and put the patched code back
+        for tracked in self.tracked_functions.values():
+            if tracked.func is func:
+                tracked.code = func.__code__
+                for num in removed:
+                    tracked.sites.pop(num, None)
+
+        # The original code has the counters and timers it had at the first
+        # patch, whatever was added or removed since
+        dropped = []
+        heatmap = self.heatmaps.pop(func, None)
+        if heatmap is not None and heatmap is not patch['heatmap']:
+            dropped.append('heatmap')
+        if patch['heatmap'] is not None:
+            self.heatmaps[func] = patch['heatmap']
+        probe = self.probes.pop(func, None)
+        if probe is not None and probe is not patch['probe']:
+            dropped.append('probe')
+        if patch['probe'] is not None:
+            self.probes[func] = patch['probe']
+        for num, (sw_func, stopwatch) in sorted(self.stopwatches.items()):
+            if sw_func is func and num not in patch['stopwatches']:
+                del self.stopwatches[num]
+                dropped.append('stopwatch {}'.format(num))
+        self.stopwatches.update(patch['stopwatches'])
+
+        print('Restored', func.__qualname__)
+        if removed:
+            print('Removed breakpoints', ', '.join(str(num) for num in removed))
+        if dropped:
+            print('Removed', ', '.join(dropped))
+
+    @line_magic
+    def heatmap(self, args):
+        """
+        %heatmap func: count the times each line of func runs, with a counter
+        at the start of every line (only func pays for it, a few instructions
+        per line). Run %heatmap func again to see its source annotated with
+        the counts. -r resets the counts, and -d removes the counters.
+        """
+        args = args.split()
+        if not args:
+            if not self.heatmaps:
+                print('No heatmaps')
+                return
+            print("Heatmaps:")
+            for func, (linenos, counts) in self.heatmaps.items():
+                print('{}\t{} line starts'.format(func.__qualname__, sum(counts)))
+            return
+
+        option = args[0] if args[0] in ('-r', '-d') else None
+        if option is not None:
+            args = args[1:]
+        if len(args) != 1:
+            return error("Syntax: %heatmap [-r|-d] func")
+
+        func = self.find_function(args[0])
+        if func is None:
+            return
+
+        heatmap = self.heatmaps.get(func)
+        if heatmap is None:
+            if option is not None:
+                return error("No heatmap for", func.__qualname__)
+            self.heatmaps[func] = add_line_counters(func)
+            print('Counting lines of', func.__qualname__)
+        elif option == '-r':
+            heatmap[1][:] = [0] * len(heatmap[1])
+        elif option == '-d':
+            remove_line_counters(func, heatmap[1])
+            del self.heatmaps[func]
+            print('Removed heatmap of', func.__qualname__)
+        else:
+            self.print_heatmap(func, *heatmap)
+
+    def print_heatmap(self, func, linenos, counts, width=20):
+        hits = dict(zip(linenos, counts))
+        top = max(counts) if counts else 0
+        try:
+            lines, start = inspect.getsourcelines(func)
+        except (OSError, TypeError):
+            # Counts alone, by line number
+            start = func.__code__.co_firstlineno
+            lines = ['\n'] * (max(linenos) - start + 1) if linenos else []
+
+        for offset, line in enumerate(lines):
+            count = hits.get(start + offset)
+            if count is None:
+                prefix = ' ' * (10 + width)
+            else:
+                # Bars are scaled to the hottest line, rounding up so that
+                # any line that ran gets at least one mark
+                bar = '#' * (-(-count * width // top) if top else 0)
+                prefix = '{:>8}  {:<{width}}'.format(count, bar, width=width)
+            print('{}{:>5}  {}'.format(prefix, start + offset, line.rstrip('\n')))
+
+    def find_function(self, name):
+        """
+        Returns the plain function that name evaluates to in the current
+        scope, or None (after printing why)
+        """
+        try:
+            func = self.frame_tracker.eval(name)
+        except:
+            error("Not found: {}".format(name))
+            return None
+        func = getattr(func, '__func__', func)
+        if not isinstance(func, types.FunctionType):
+            error("Not a function:", name)
+            return None
+        return func
+
+    @line_magic
+    def probe(self, args):
+        """
+        %probe func [func ...]: time every call of the functions, with a
+        timestamp taken at entry and before each return (only the probed
+        functions pay for it). The latest calls of each function are kept in
+        a ring buffer of constant size. Run %probe func again
+        for a histogram of its latencies, or %probe with no arguments for a
+        summary. -o path writes the calls as a Chrome/Perfetto trace, -r
+        resets the probes, and -d func removes one.
+        """
+        args = args.split()
+        if not args:
+            if not self.probes:
+                print('No probes')
+                return
+            for func, probe in self.probes.items():
+                print('{}\t{}'.format(probe.name, probe.histogram().summary()))
+            return
+
+        if args[0] == '-o':
+            if len(args) != 2:
+                return error("Syntax: %probe -o path")
+            try:
+                count = write_chrome_trace(args[1], self.probes.values())
+            except OSError as e:
+                return error("Could not write {}: {}".format(args[1], e))
+            print('Wrote {} calls to {}'.format(count, args[1]))
+            return
+
+        if args[0] == '-r':
+            for probe in self.probes.values():
+                probe.reset()
+            return
+
+        if args[0] == '-d':
+            if len(args) != 2:
+                return error("Syntax: %probe -d func")
+            func = self.find_function(args[1])
+            if func is None:
+                return
+            probe = self.probes.pop(func, None)
+            if probe is None:
+                return error("No probe in", func.__qualname__)
+            remove_probe(func, probe)
+            print('Removed probe from', probe.name)
+            return
+
+        funcs = [self.find_function(name) for name in args]
+        if None in funcs:
+            return
+        for func in funcs:
+            probe = self.probes.get(func)
+            if probe is not None:
+                histogram = probe.histogram()
+                print('{}: {}'.format(probe.name, histogram.summary()))
+                for line in histogram.format():
+                    print(line)
+                continue
+            probe = Probe(func.__qualname__)
+            try:
+                add_probe(func, probe, clock, threading.get_ident)
+            except ValueError as e:
+                error("Could not add probe to {}: {}".format(func.__qualname__, e))
+                continue
+            self.probes[func] = probe
+            print('Probing', probe.name)
+
+    @line_magic
+    def stopwatch(self, args):
+        """
+        %stopwatch func a b: time every stretch of func from reaching line a
+        to reaching line b, into a histogram of constant size. Only the two
+        lines pay for it. %stopwatch with no arguments lists the stopwatches,
+        %stopwatch N shows the histogram of one, -r resets them, and -d N
+        removes one.
+        """
+        args = args.split()
+        if not args:
+            if not self.stopwatches:
+                print('No stopwatches')
+                return
+            for num, (func, stopwatch) in sorted(self.stopwatches.items()):
+                print('{}\t{}\t{}'.format(num, stopwatch.name, stopwatch.histogram.summary()))
+            return
+
+        if args[0] == '-r':
+            for func, stopwatch in self.stopwatches.values():
+                stopwatch.histogram.reset()
+            return
+
+        if len(args) <= 2:
+            if args[0] == '-d':
+                if len(args) != 2:
+                    return error("Syntax: %stopwatch -d N")
+                num = args[1]
+            elif len(args) == 1:
+                num = args[0]
+            else:
+                return error("Syntax: %stopwatch func a b")
+            try:
+                func, stopwatch = self.stopwatches[int(num)]
+            except (ValueError, KeyError):
+                return error("No stopwatch", num)
+            if args[0] == '-d':
+                remove_stopwatch(func, stopwatch)
+                del self.stopwatches[int(num)]
+                print('Removed stopwatch', stopwatch.name)
+                return
+            print('{}: {}'.format(stopwatch.name, stopwatch.histogram.summary()))
+            for line in stopwatch.histogram.format():
+                print(line)
+            return
+
+        if len(args) != 3:
+            return error("Syntax: %stopwatch func a b")
+        func = self.find_function(args[0])
+        if func is None:
+            return
+        try:
+            start_lineno, stop_lineno = int(args[1]), int(args[2])
+        except ValueError:
+            return error("Syntax: %stopwatch func a b")
+        stopwatch = Stopwatch(self.stopwatch_counter, func.__qualname__, start_lineno, stop_lineno)
+        try:
+            add_stopwatch(func, stopwatch, clock, CLOCK_SECONDS)
+        except ValueError as e:
+            return error("Could not add stopwatch to {}: {}".format(func.__qualname__, e))
+        self.stopwatch_counter += 1
+        self.stopwatches[stopwatch.number] = (func, stopwatch)
+        print('New stopwatch {}: {}'.format(stopwatch.number, stopwatch.name))
+
+    @line_magic
+    def catch(self, args):
+        """
+        Stop when an exception of the given type propagates out of a function
+        defined in a module (or package). A bare `return` lets the exception
+        continue, while `return value` makes the function return value.
+        """
+        args = args.split()
+        if not args or len(args) > 2:
+            return error("Syntax: %catch ExcType [module]")
+
+        try:
+            exc_type = self.frame_tracker.eval(args[0])
+        except:
+            return error("Not found: {}".format(args[0]))
+        if not (isinstance(exc_type, type) and issubclass(exc_type, BaseException)):
+            return error("Not an exception type:", args[0])
+
+        if len(args) == 2:
+            package = args[1]
+            modules = [module for name, module in list(sys.modules.items())
+                if module is not None and (name == package or name.startswith(package + '.'))]
+            if not modules:
+                return error("Module not found: {}".format(package))
+        else:
+            package = self.shell.user_module.__name__
+            modules = [self.shell.user_module]
+
+        funcs = []
+        for module in modules:
+            funcs.extend(find_functions(module))
+
+        num = self.breakpoint_table.new_breakpoint(None, None,
+            name="catch {} in {}".format(exc_type.__name__, package))
+        self.breakpoint_table.b_catch_types[num] = exc_type
+
+        instrumented = 0
+        for func in funcs:
+            try:
+                if add_exception_hook(self.breakpoint_table, func, num):
+                    instrumented += 1
+            except Exception:
+                pass
+
+        print('New breakpoint {} ({} functions)'.format(num, instrumented))
+
+    @line_magic
+    def memo(self, args):
+        """
+        Cache the results of a function by the values of its arguments, and
+        return them on later calls without running the function. Results are
+        also pickled into path, if given, so they survive a kernel restart.
+        """
+        args = args.split()
+        if not args:
+            if not self.breakpoint_table.b_memos:
+                print('No memoized functions')
+                return
+            print("Memoized functions:")
+            for num, memo in sorted(self.breakpoint_table.b_memos.items()):
+                print('{}\t{}\t{} cached, {} hits, {} misses'.format(num,
+                    self.breakpoint_table.b_names[num], len(memo.entries),
+                    memo.hits, memo.misses),
+                    memo.path if memo.path is not None else '')
+            return
+
+        if args[0] == 'clear':
+            if len(args) != 2:
+                return error("Syntax: %memo clear bpnumber")
+            try:
+                num = int(args[1])
+            except ValueError:
+                return error("Invalid breakpoint number:", args[1])
+            memo = self.breakpoint_table.b_memos.get(num)
+            if memo is None:
+                return error("Not a memoized function:", num)
+            memo.clear()
+            return
+
+        if len(args) > 3:
+            return error("Syntax: %memo func [maxsize] [path]")
+
+        func = self.find_function(args[0])
+        if func is None:
+            return
+
+        maxsize = 128
+        path = None
+        for arg in args[1:]:
+            try:
+                maxsize = int(arg)
+            except ValueError:
+                path = arg
+
+        num = self.breakpoint_table.new_breakpoint(func, None,
+            name="memo {}".format(func.__qualname__))
+        try:
+            add_memo_hook(self.breakpoint_table, func, num)
+        except ValueError as e:
+            self.breakpoint_table.remove_breakpoint(num)
+            return error("Could not memoize:", e)
+
+        self.breakpoint_table.b_memos[num] = MemoCache(get_arg_names(func.__code__),
+            maxsize=maxsize, path=path)
+        print('New memo', num)
+
+    def find_capture(self, func):
+        for num, store in self.breakpoint_table.b_captures.items():
+            if store.func is func:
+                return num, store
+        return None, None
+
+    @line_magic
+    def capture(self, args):
+        """
+        Pickle the arguments of every call to a function into a directory
+        (a new temporary one by default), so that calls can be re-run with
+        %replay. With --globals, the globals that the function reads are
+        saved too.
+        """
+        args = args.split()
+        with_globals = '--globals' in args
+        args = [arg for arg in args if arg != '--globals']
+
+        if not args:
+            if not self.breakpoint_table.b_captures:
+                print('No captures')
+                return
+            print("Captures:")
+            for num, store in sorted(self.breakpoint_table.b_captures.items()):
+                print('{}\t{}\t{} calls\t{}'.format(num, store.func.__qualname__,
+                    store.count, store.path),
+                    '({} errors)'.format(store.errors) if store.errors else '')
+            return
+
+        if len(args) > 2:
+            return error("Syntax: %capture func [path] [--globals]")
+
+        func = self.find_function(args[0])
+        if func is None:
+            return
+        if self.find_capture(func)[1] is not None:
+            return error("Already capturing:", args[0])
+
+        if len(args) == 2:
+            path = args[1]
+        else:
+            path = tempfile.mkdtemp(prefix='xdbg-capture-')
+
+        global_names = ()
+        if with_globals:
+            global_names = find_global_names(func.__code__, func.__globals__)
+
+        try:
+            num = add_logpoint(self.breakpoint_table, func, None, 'locals()',
+                method='capture')
+        except (SyntaxError, ValueError) as e:
+            return error("Could not add capture:", e)
+
+        store = CaptureStore(path, func, get_arg_names(func.__code__),
+            global_names=global_names)
+        self.breakpoint_table.b_names[num] = "capture {}".format(func.__qualname__)
+        self.breakpoint_table.b_captures[num] = store
+        print('New capture {} ({})'.format(num, path))
+        if store.count:
+            print('{} calls already captured'.format(store.count))
+
+    @line_magic
+    def replay(self, args):
+        """
+        Re-run a call saved by %capture, by its index (negative indices count
+        from the end). Without an index, list the saved calls.
+        """
+        args = args.split()
+        if not args or len(args) > 2:
+            return error("Syntax: %replay func [N]")
+
+        func = self.find_function(args[0])
+        if func is None:
+            return
+        num, store = self.find_capture(func)
+        if store is None:
+            return error("Not captured:", args[0])
+
+        if len(args) == 1:
+            if not store.count:
+                print('No captured calls')
+            for index in range(store.count):
+                try:
+                    call = store.load(index)
+                except Exception as e:
+                    print('{}\t<error: {!r}>'.format(index, e))
+                    continue
+                text = ', '.join('{}={!r}'.format(name, value)
+                    for name, value in call['args'].items())
+                if len(text) > 100:
+                    text = text[:97] + '...'
+                print('{}\t{}'.format(index, text))
+            return
+
+        try:
+            index = int(args[1])
+        except ValueError:
+            return error("Invalid call number:", args[1])
+        try:
+            call = store.load(index)
+        except IndexError as e:
+            return error(e)
+
+        store.replaying = True
+        try:
+            return replay_call(func, call)
+        finally:
+            store.replaying = False
+
     @line_magic
     def tbreak(self, args):
         return self.break_(args, temporary=True)
 
+    @line_magic
+    def logpoint(self, args):
+        """
+        Record the values of expressions whenever a line is reached, without
+        stopping there
+        """
+        args = args.split(None, 2)
+        if len(args) != 3:
+            return error("Syntax: %logpoint func lineno expr[, expr ...]")
+
+        try:
+            func = self.frame_tracker.eval(args[0])
+        except:
+            return error("Not found: {}".format(args[0]))
+
+        try:
+            lineno = int(args[1])
+        except ValueError:
+            return error("Invalid line number:", args[1])
+
+        try:
+            num = add_logpoint(self.breakpoint_table, func, lineno, args[2])
+        except (SyntaxError, ValueError) as e:
+            return error("Could not add logpoint:", e)
+
+        self.breakpoint_table.b_log_exprs[num] = args[2]
+        print('New logpoint', num)
+
+    @line_magic
+    def record(self, args):
+        """
+        Record the values of variables at a line into a columnar trace on disk,
+        without stopping there. The trace can be opened later with
+        xdbg.trace_file.Trace(path).
+        """
+        args = args.split()
+        if not args:
+            if not self.breakpoint_table.b_traces:
+                print('No recordings')
+                return
+            print("Recordings:")
+            for num, trace in sorted(self.breakpoint_table.b_traces.items()):
+                trace.flush()
+                print('{}\t{}\t{} rows'.format(num, trace.path, trace.rows),
+                      '({} errors)'.format(trace.errors) if trace.errors else '',
+                      '(closed)' if trace.closed else '')
+            return
+
+        if args[0] == 'close':
+            if len(args) != 2:
+                return error("Syntax: %record close bpnumber")
+            try:
+                num = int(args[1])
+            except ValueError:
+                return error("Invalid breakpoint number:", args[1])
+            trace = self.breakpoint_table.b_traces.get(num)
+            if trace is None:
+                return error("Not a recording:", num)
+            self.breakpoint_table.modify_breakpoints([num], enabled=False)
+            trace.close()
+            print('Closed {} ({} rows)'.format(trace.path, trace.rows))
+            return
+
+        if len(args) < 4:
+            return error("Syntax: %record func lineno path var [var ...]")
+
+        try:
+            func = self.frame_tracker.eval(args[0])
+        except:
+            return error("Not found: {}".format(args[0]))
+
+        try:
+            lineno = int(args[1])
+        except ValueError:
+            return error("Invalid line number:", args[1])
+
+        path, names = args[2], args[3:]
+        for name in names:
+            if not name.isidentifier():
+                return error("Not a variable name:", name)
+
+        try:
+            num = add_logpoint(self.breakpoint_table, func, lineno, ', '.join(names),
+                method='record')
+        except (SyntaxError, ValueError) as e:
+            return error("Could not add recording:", e)
+
+        # Only created once the hook is in, so that a failed %record leaves
+        # nothing on disk. Hits before then aren't recorded.
+        try:
+            trace = TraceFile(path, names)
+        except OSError as e:
+            remove_logpoint(self.breakpoint_table, func, num)
+            self.breakpoint_table.remove_breakpoint(num)
+            return error("Could not create {}: {}".format(path, e))
+        self.breakpoint_table.b_traces[num] = trace
+        print('New recording', num)
+
+    @line_magic
+    def logs(self, args):
+        """
+        Show the values recorded by logpoints, oldest first
+        """
+        log_buffer = self.breakpoint_table.log_buffer
+        args = args.strip()
+        if args == 'clear':
+            log_buffer.clear()
+            return
+
+        try:
+            last = int(args) if args else None
+        except ValueError:
+            return error("Syntax: %logs [count|clear]")
+
+        entries = log_buffer.read(last)
+        if not entries:
+            print('No logpoint hits')
+            return
+
+        dropped = log_buffer.count - min(log_buffer.count, log_buffer.capacity)
+        if dropped and last is None:
+            print('({} older hits were overwritten)'.format(dropped))
+        for hit_index, num, values in entries:
+            exprs = self.breakpoint_table.b_log_exprs.get(num, '?')
+            if isinstance(values, LogError):
+                print('{}\t[{}] {}: {!r}'.format(hit_index, num, exprs, values))
+            else:
+                print('{}\t[{}] {} = {}'.format(hit_index, num, exprs,
+                    ', '.join(repr(value) for value in values)))
+
+    @line_magic('locals')
+    def locals_(self, args):
+        """
+        List the variables of the current frame with their type, shape, dtype
+        and estimated size, largest first. Sizing stops after a time budget
+        (-t seconds, 1 by default), so huge frames stay responsive.
+        """
+        args = args.split()
+        budget = 1.0
+        if len(args) >= 2 and args[0] == '-t':
+            try:
+                budget = float(args[1])
+            except ValueError:
+                return error("Syntax: %locals [-t seconds] [name ...]")
+            args = args[2:]
+
+        namespace = self.frame_tracker.current_locals()
+        hidden = self.shell.user_ns_hidden
+        if args:
+            missing = [name for name in args if name not in namespace]
+            if missing:
+                return error("Not found:", ', '.join(missing))
+            namespace = {name: namespace[name] for name in args}
+        else:
+            namespace = {name: value for name, value in sorted(namespace.items())
+                if not name.startswith('_')
+                    and not (name in hidden and hidden[name] is value)
+                    and not isinstance(value, types.ModuleType)}
+
+        if not namespace:
+            print('No locals')
+            return
+
+        rows = [('Name', 'Type', 'Shape', 'Dtype', 'Size')]
+        rows.extend(describe_locals(namespace, budget))
+        widths = [max(len(row[i]) for row in rows if row[i] is not None)
+            for i in range(4)]
+        skipped = 0
+        for row in rows:
+            if row[4] is None:
+                skipped += 1
+            print('  '.join(text.ljust(width) for text, width in zip(row, widths)),
+                row[4] if row[4] is not None else '?')
+        if skipped:
+            print('({} not sized within {}s)'.format(skipped, budget))
+
     def modify_breakpoints(self, args, enabled=None):
         if not args or args == '?':
             self.print_breakpoints(enabled=(None if enabled is None else (not enabled)))